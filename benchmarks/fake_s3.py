@@ -0,0 +1,393 @@
+#!/usr/local/bin/python3
+
+# standard lib imports
+import sys
+import json
+import time
+import argparse
+import hashlib
+import threading
+import collections
+from datetime import datetime
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# third party lib imports
+from boto.s3.connection import OrdinaryCallingFormat
+
+
+_TIME_FMT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+
+class FakeS3Server(object):
+    """in-process, path-style S3 endpoint backed by dicts. Supports the calls made by botowraps.s3:
+    bucket listing, object PUT/GET/HEAD (with Range), multi-object delete and the multipart upload API.
+
+    'latency' seconds are added to every request. A 'fail_rate' share of part uploads fail on their first attempt,
+    picked deterministically (every 1/fail_rate-th part to arrive), so retries happen on every run and retried parts succeed.
+    Injected failures answer with 'fail_status', note boto retries 5xx responses itself before raising.
+    GET /_stats returns the request counters as JSON and POST /_reset clears them, for servers run in another process"""
+
+    def __init__(self, buckets=("bench-bucket",), latency=0.0, fail_rate=0.0, fail_status=500):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self._fail_credit = 0.0  # accumulates fail_rate per first part attempt, a part fails each time it reaches 1
+        self._attempted = set()  # (upload id, part number) seen
+        self.lock = threading.Lock()
+        self.buckets = {name: {} for name in buckets}  # bucket -> key -> (bytes, etag, last_modified)
+        self.uploads = {}  # upload id -> {"bucket", "key", "initiated", "parts": {num: (bytes, etag)}}
+        self.counts = collections.Counter()  # operation name -> requests served
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._next_id = 0
+
+        server = self
+
+        class Handler(_Handler):
+            fake = server
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def s3conf(self):
+        """kwargs for boto's S3Connection, usable as the 's3conf' argument of botowraps.s3 classes"""
+        return s3conf(self.port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts.clear()
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def round_trips(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def stats(self):
+        with self.lock:
+            return {"round_trips": sum(self.counts.values()), "requests": dict(self.counts),
+                    "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+    def new_upload_id(self):
+        with self.lock:
+            self._next_id += 1
+            return "upload-%d" % self._next_id
+
+    def should_fail(self, upload_id, part_number):
+        with self.lock:
+            if self.fail_rate <= 0 or (upload_id, part_number) in self._attempted:
+                return False
+            self._attempted.add((upload_id, part_number))
+            self._fail_credit += self.fail_rate
+            if self._fail_credit >= 1 - 1e-9:  # 10 x 0.1 sums to just below 1
+                self._fail_credit -= 1
+                return True
+            return False
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    # request parsing
+    def _route(self):
+        parsed = urlparse(self.path)
+        parts = parsed.path.lstrip("/").split("/", 1)
+        bucket = unquote(parts[0])
+        key = unquote(parts[1]) if len(parts) > 1 else ""
+        query = {k: v[0] for k, v in parse_qs(parsed.query, keep_blank_values=True).items()}
+        return bucket, key, query
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else b""
+        with self.fake.lock:
+            self.fake.bytes_in += len(data)
+        return data
+
+    def _count(self, op):
+        with self.fake.lock:
+            self.fake.counts[op] += 1
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+
+    # responses
+    def _send(self, status, body=b"", headers=None, head=False):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head and body:
+            self.wfile.write(body)
+            with self.fake.lock:
+                self.fake.bytes_out += len(body)
+
+    def _xml(self, status, body):
+        self._send(status, '<?xml version="1.0" encoding="UTF-8"?>\n' + body, {"Content-Type": "application/xml"})
+
+    def _error(self, status, code):
+        self._xml(status, "<Error><Code>%s</Code><Message>%s</Message></Error>" % (code, code))
+
+    def _objects(self, bucket):
+        objects = self.fake.buckets.get(bucket)
+        if objects is None:
+            self._error(404, "NoSuchBucket")
+        return objects
+
+    # verbs
+    def do_GET(self):
+        if self.path == "/_stats":
+            return self._send(200, json.dumps(self.fake.stats()), {"Content-Type": "application/json"})
+        bucket, key, query = self._route()
+        objects = self._objects(bucket)
+        if objects is None:
+            return
+
+        if not key and "uploads" in query:
+            self._count("list_uploads")
+            prefix = query.get("prefix", "")
+            marker = (query.get("key-marker", ""), query.get("upload-id-marker", ""))
+            max_uploads = min(int(query.get("max-uploads", 1000)), 1000)
+            with self.fake.lock:
+                uploads = sorted((u["key"], uid, u["initiated"]) for uid, u in self.fake.uploads.items()
+                                 if u["bucket"] == bucket and u["key"].startswith(prefix))
+            if marker[0]:
+                # uploads of the marker key after the marker id, then later keys
+                uploads = [u for u in uploads if u[0] > marker[0] or (u[0] == marker[0] and marker[1] and u[1] > marker[1])]
+            page = uploads[:max_uploads]
+            body = "".join(
+                "<Upload><Key>%s</Key><UploadId>%s</UploadId><Initiated>%s</Initiated></Upload>"
+                % (escape(k), uid, initiated) for k, uid, initiated in page)
+            if len(uploads) > max_uploads:
+                body = "<IsTruncated>true</IsTruncated><NextKeyMarker>%s</NextKeyMarker><NextUploadIdMarker>%s</NextUploadIdMarker>%s" % (
+                    escape(page[-1][0]), page[-1][1], body)
+            else:
+                body = "<IsTruncated>false</IsTruncated>" + body
+            self._xml(200, "<ListMultipartUploadsResult><Bucket>%s</Bucket><MaxUploads>%d</MaxUploads>%s</ListMultipartUploadsResult>"
+                      % (bucket, max_uploads, body))
+
+        elif not key:
+            self._count("list")
+            prefix = query.get("prefix", "")
+            marker = query.get("marker", "")
+            max_keys = min(int(query.get("max-keys", 1000)), 1000)
+            with self.fake.lock:
+                names = sorted(k for k in objects if k.startswith(prefix) and k > marker)
+                page = names[:max_keys]
+                entries = [(k, objects[k]) for k in page]
+            body = "".join(
+                "<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag><Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>"
+                % (escape(k), v[2], escape(v[1]), len(v[0])) for k, v in entries)
+            truncated = "true" if len(names) > max_keys else "false"
+            self._xml(200, "<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix><MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>%s</ListBucketResult>"
+                      % (bucket, escape(prefix), max_keys, truncated, body))
+
+        elif "uploadId" in query:
+            self._count("list_parts")
+            marker = int(query.get("part-number-marker") or 0)
+            max_parts = min(int(query.get("max-parts", 1000)), 1000)
+            with self.fake.lock:
+                upload = self.fake.uploads.get(query["uploadId"])
+                parts = sorted(p for p in upload["parts"].items() if p[0] > marker) if upload else None
+            if parts is None:
+                return self._error(404, "NoSuchUpload")
+            page = parts[:max_parts]
+            body = "".join(
+                "<Part><PartNumber>%d</PartNumber><LastModified>%s</LastModified><ETag>%s</ETag><Size>%d</Size></Part>"
+                % (num, upload["initiated"], escape(etag), len(data)) for num, (data, etag) in page)
+            if len(parts) > max_parts:
+                body = "<IsTruncated>true</IsTruncated><NextPartNumberMarker>%d</NextPartNumberMarker>%s" % (page[-1][0], body)
+            else:
+                body = "<IsTruncated>false</IsTruncated>" + body
+            self._xml(200, "<ListPartsResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId><MaxParts>%d</MaxParts>%s</ListPartsResult>"
+                      % (bucket, escape(key), query["uploadId"], max_parts, body))
+
+        else:
+            self._get_object(objects, key, head=False)
+
+    def do_HEAD(self):
+        bucket, key, query = self._route()
+        objects = self.fake.buckets.get(bucket)
+        if objects is None:
+            return self._send(404, head=True)
+        if not key:
+            self._count("head_bucket")
+            return self._send(200, head=True)
+        self._get_object(objects, key, head=True)
+
+    def _get_object(self, objects, key, head):
+        self._count("head" if head else "get")
+        with self.fake.lock:
+            entry = objects.get(key)
+        if entry is None:
+            return self._send(404, head=True) if head else self._error(404, "NoSuchKey")
+        data, etag, modified = entry
+        headers = {
+            "ETag": etag,
+            "Last-Modified": datetime.strptime(modified, _TIME_FMT).strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Content-Type": "application/octet-stream",
+            "Accept-Ranges": "bytes",
+        }
+        status = 200
+        byte_range = self.headers.get("Range")
+        if byte_range and not head:
+            start, end = byte_range.split("=", 1)[1].split("-")
+            start = int(start)
+            end = min(int(end) if end else len(data) - 1, len(data) - 1)
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+            data = data[start:end + 1]
+            status = 206
+        if head:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+        else:
+            self._send(status, data, headers)
+
+    def do_PUT(self):
+        bucket, key, query = self._route()
+        data = self._body()
+        objects = self._objects(bucket)
+        if objects is None:
+            return
+
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if "uploadId" in query:
+            self._count("upload_part")
+            if self.fake.should_fail(query["uploadId"], query["partNumber"]):
+                return self._error(self.fake.fail_status, "InternalError" if self.fake.fail_status >= 500 else "BadDigest")
+            with self.fake.lock:
+                upload = self.fake.uploads.get(query["uploadId"])
+                if upload is not None:
+                    upload["parts"][int(query["partNumber"])] = (data, etag)
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+        else:
+            self._count("put")
+            with self.fake.lock:
+                objects[key] = (data, etag, datetime.utcnow().strftime(_TIME_FMT))
+        self._send(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        if self.path == "/_reset":
+            self._body()
+            self.fake.reset_counts()
+            return self._send(204)
+        bucket, key, query = self._route()
+        body = self._body()
+        objects = self._objects(bucket)
+        if objects is None:
+            return
+
+        if "uploads" in query:
+            self._count("initiate")
+            upload_id = self.fake.new_upload_id()
+            with self.fake.lock:
+                self.fake.uploads[upload_id] = {"bucket": bucket, "key": key, "parts": {},
+                                                "initiated": datetime.utcnow().strftime(_TIME_FMT)}
+            self._xml(200, "<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId></InitiateMultipartUploadResult>"
+                      % (bucket, escape(key), upload_id))
+
+        elif "uploadId" in query:
+            self._count("complete")
+            with self.fake.lock:
+                upload = self.fake.uploads.pop(query["uploadId"], None)
+                if upload is not None:
+                    parts = [upload["parts"][n] for n in sorted(upload["parts"])]
+                    digest = hashlib.md5(b"".join(hashlib.md5(d).digest() for d, _ in parts)).hexdigest()
+                    etag = '"%s-%d"' % (digest, len(parts))
+                    objects[key] = (b"".join(d for d, _ in parts), etag, datetime.utcnow().strftime(_TIME_FMT))
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+            self._xml(200, "<CompleteMultipartUploadResult><Location>/%s/%s</Location><Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag></CompleteMultipartUploadResult>"
+                      % (bucket, escape(key), bucket, escape(key), escape(etag)))
+
+        elif "delete" in query:
+            self._count("delete_keys")
+            root = ET.fromstring(body)
+            names = [el.text for el in root.iter() if el.tag.endswith("Key")]
+            with self.fake.lock:
+                for name in names:
+                    objects.pop(name, None)
+            self._xml(200, "<DeleteResult>%s</DeleteResult>" % "".join("<Deleted><Key>%s</Key></Deleted>" % escape(n) for n in names))
+
+        else:
+            self._error(400, "InvalidRequest")
+
+    def do_DELETE(self):
+        bucket, key, query = self._route()
+        objects = self._objects(bucket)
+        if objects is None:
+            return
+        if "uploadId" in query:
+            self._count("abort")
+            with self.fake.lock:
+                self.fake.uploads.pop(query["uploadId"], None)
+        else:
+            self._count("delete")
+            with self.fake.lock:
+                objects.pop(key, None)
+        self._send(204)
+
+
+def s3conf(port):
+    """kwargs for boto's S3Connection pointing at a fake server on 'port'"""
+    return {
+        "aws_access_key_id": "fake",
+        "aws_secret_access_key": "fake",
+        "host": "127.0.0.1",
+        "port": port,
+        "is_secure": False,
+        "calling_format": OrdinaryCallingFormat(),
+    }
+
+
+def main(argv=None):
+    # serves until killed, the first line written to stdout is the port
+    parser = argparse.ArgumentParser(description="in-process fake S3 endpoint")
+    parser.add_argument("--bucket", action="append", default=None)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--fail-status", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    server = FakeS3Server(buckets=args.bucket or ["bench-bucket"], latency=args.latency, fail_rate=args.fail_rate,
+                          fail_status=args.fail_status)
+    sys.stdout.write("%d\n" % server.port)
+    sys.stdout.flush()
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
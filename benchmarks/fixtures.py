@@ -0,0 +1,53 @@
+#!/usr/local/bin/python3
+
+# standard lib imports
+import os
+import random
+
+
+def synthetic_csv(filename, rows, header=True, delimiter=",", seed=0):
+    """writes a deterministic .csv file of 'rows' rows shaped like a typical fact table:
+    id, date, category, amount, flag and a free text column. Returns filename"""
+    rng = random.Random(seed)
+    categories = ["alpha", "beta", "gamma", "delta", "epsilon"]
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+    with open(filename, "w") as fo:
+        if header:
+            fo.write(delimiter.join(["id", "date", "category", "amount", "flag", "note"]) + "\n")
+        lines = []
+        for i in range(rows):
+            lines.append(delimiter.join([
+                str(i),
+                "2020-%02d-%02d" % (i % 12 + 1, i % 28 + 1),
+                categories[i % len(categories)],
+                "%.2f" % (rng.random() * 1000),
+                "t" if i % 2 else "f",
+                " ".join(rng.choice(words) for _ in range(rng.randint(1, 8))),
+            ]))
+            if len(lines) == 10000:
+                fo.write("\n".join(lines) + "\n")
+                lines = []
+        if lines:
+            fo.write("\n".join(lines) + "\n")
+    return filename
+
+
+def synthetic_csv_mb(filename, size_mb, header=True, seed=0):
+    """writes a synthetic .csv file of about 'size_mb' megabytes, returns (filename, rows)"""
+    # rows average close to 60 bytes, sized from a small sample to hit the target
+    sample = synthetic_csv(filename, 1000, header=False, seed=seed)
+    per_row = os.path.getsize(sample) / 1000.0
+    rows = max(1, int(size_mb * 2**20 / per_row))
+    return synthetic_csv(filename, rows, header=header, seed=seed), rows
+
+
+def random_file(filename, size_mb, seed=0):
+    """writes 'size_mb' megabytes of incompressible bytes, returns filename"""
+    rng = random.Random(seed)
+    remaining = int(size_mb * 2**20)
+    with open(filename, "wb") as fo:
+        while remaining > 0:
+            n = min(remaining, 2**20)
+            fo.write(rng.getrandbits(8 * n).to_bytes(n, "little"))
+            remaining -= n
+    return filename
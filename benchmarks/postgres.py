@@ -0,0 +1,55 @@
+#!/usr/local/bin/python3
+
+# standard lib imports
+import os
+import socket
+import shutil
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+# third party lib imports
+from psycopg2.extensions import parse_dsn
+
+
+DSN_ENV = "BOTOWRAPS_BENCH_DSN"
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def local_postgres():
+    """yields a connection conf for botowraps.redshift functions, or None when no Postgres is available.
+
+    Uses the DSN in the BOTOWRAPS_BENCH_DSN environment variable if set. Otherwise, if initdb and pg_ctl are on
+    the PATH, a throwaway cluster is created in a temp directory, started on a free port and removed afterwards.
+    Postgres stands in for the leader node: queries and fetches are exercised, Redshift-only SQL is not"""
+    dsn = os.environ.get(DSN_ENV)
+    if dsn:
+        conf = parse_dsn(dsn)
+        conf["database"] = conf.pop("dbname", "postgres")
+        yield conf
+        return
+
+    if shutil.which("initdb") is None or shutil.which("pg_ctl") is None:
+        yield None
+        return
+
+    datadir = tempfile.mkdtemp(prefix="botowraps_pg_")
+    port = _free_port()
+    try:
+        subprocess.run(["initdb", "-D", datadir, "-U", "bench", "--auth=trust"], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(["pg_ctl", "-D", datadir, "-w", "-l", os.path.join(datadir, "server.log"),
+                        "-o", "-p %d -k %s -c listen_addresses=127.0.0.1" % (port, datadir), "start"],
+                       check=True, stdout=subprocess.DEVNULL)
+        try:
+            yield {"host": "127.0.0.1", "port": port, "user": "bench", "password": "", "database": "postgres"}
+        finally:
+            subprocess.run(["pg_ctl", "-D", datadir, "-m", "fast", "stop"], stdout=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(datadir, ignore_errors=True)
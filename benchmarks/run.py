@@ -0,0 +1,297 @@
+#!/usr/local/bin/python3
+"""offline benchmark runner for botowraps.
+
+Every scenario runs in its own subprocess so peak RSS is measured per scenario. S3 scenarios talk to a fake S3
+server run as a separate process (so stored objects do not count towards RSS), query scenarios to the Postgres
+given by BOTOWRAPS_BENCH_DSN or a throwaway local cluster, and are skipped when neither is available.
+Results are written as JSON, e.g.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --scenario upload_thread --scenario gzc_parallel --size-mb 128
+"""
+
+# standard lib imports
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime
+
+# local imports
+from benchmarks import fixtures
+from benchmarks.fake_s3 import s3conf
+from benchmarks.postgres import DSN_ENV, local_postgres
+from botowraps import utils
+from botowraps.metrics import MetricsAggregator
+from botowraps.s3 import S3Uploader, S3Downloader
+
+
+BUCKET = "bench-bucket"
+
+
+class Skip(Exception):
+    """raised by a scenario whose backend is not available"""
+
+
+@contextmanager
+def fake_s3(opts, fail_rate=0.0):
+    """starts benchmarks.fake_s3 in a subprocess, yields its port"""
+    cmd = [sys.executable, "-m", "benchmarks.fake_s3", "--latency", str(opts.latency), "--fail-rate", str(fail_rate),
+           "--fail-status", "400"]
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        port = int(server.stdout.readline())
+        yield port
+    finally:
+        server.kill()
+        server.wait()
+
+
+def s3_stats(port, reset=False):
+    if reset:
+        urllib.request.urlopen(urllib.request.Request("http://127.0.0.1:%d/_reset" % port, data=b"", method="POST")).read()
+        return None
+    return json.loads(urllib.request.urlopen("http://127.0.0.1:%d/_stats" % port).read().decode("utf-8"))
+
+
+def _timed(func):
+    start = time.time()
+    result = func()
+    return result, time.time() - start
+
+
+def _s3_result(port, nbytes, seconds, agg):
+    stats = s3_stats(port)
+    report = agg.report()
+    part = report.get("part", {})
+    return {
+        "seconds": seconds,
+        "mb_per_s": nbytes / 2**20 / seconds,
+        "round_trips": stats["round_trips"],
+        "requests": stats["requests"],
+        "parts": part.get("count", 0),
+        "retries": part.get("retries", {}).get("total", 0),
+        "part_latency_p50": part.get("latency", {}).get("p50"),
+        "part_latency_p99": part.get("latency", {}).get("p99"),
+        "part_queued_p50": part.get("queued", {}).get("p50"),
+    }
+
+
+def _upload(workdir, opts, executor, fail_rate=0.0):
+    filename = fixtures.random_file(os.path.join(workdir, "payload"), opts.size_mb, seed=opts.seed)
+    with fake_s3(opts, fail_rate) as port, MetricsAggregator() as agg:
+        with S3Uploader(s3conf(port), BUCKET, threads=opts.threads, executor=executor) as uploader:
+            keyname, seconds = _timed(lambda: uploader.upload(filename, "payload"))
+            if keyname is None:
+                raise RuntimeError("upload failed")
+        return _s3_result(port, os.path.getsize(filename), seconds, agg)
+
+
+def upload_thread(workdir, opts):
+    return _upload(workdir, opts, "thread")
+
+
+def upload_process(workdir, opts):
+    return _upload(workdir, opts, "process")
+
+
+def upload_retry(workdir, opts):
+    result = _upload(workdir, opts, "thread", fail_rate=opts.fail_rate)
+    if result["retries"] == 0:
+        raise RuntimeError("no part was retried, increase --fail-rate or --size-mb")
+    return result
+
+
+def upload_stream(workdir, opts):
+    filename = fixtures.random_file(os.path.join(workdir, "payload"), opts.size_mb, seed=opts.seed)
+    with fake_s3(opts) as port, MetricsAggregator() as agg:
+        with S3Uploader(s3conf(port), BUCKET, threads=opts.threads, executor="thread") as uploader, open(filename, "rb") as fi:
+            keyname, seconds = _timed(lambda: uploader.upload_stream(fi, "payload"))
+            if keyname is None:
+                raise RuntimeError("upload failed")
+        return _s3_result(port, os.path.getsize(filename), seconds, agg)
+
+
+def upload_many(workdir, opts):
+    files = [fixtures.random_file(os.path.join(workdir, "payload_%d" % i), opts.size_mb / 8.0, seed=opts.seed + i) for i in range(8)]
+    with fake_s3(opts) as port, MetricsAggregator() as agg:
+        with S3Uploader(s3conf(port), BUCKET, threads=opts.threads, executor="thread") as uploader:
+            keynames, seconds = _timed(lambda: uploader.upload_many(files))
+            if None in keynames:
+                raise RuntimeError("upload failed")
+        return _s3_result(port, sum(os.path.getsize(f) for f in files), seconds, agg)
+
+
+def download(workdir, opts):
+    filename = fixtures.random_file(os.path.join(workdir, "payload"), opts.size_mb, seed=opts.seed)
+    with fake_s3(opts) as port:
+        with S3Uploader(s3conf(port), BUCKET, threads=opts.threads, executor="thread") as uploader:
+            uploader.upload(filename, "payload")
+        s3_stats(port, reset=True)
+        with MetricsAggregator() as agg, S3Downloader(s3conf(port), BUCKET, threads=opts.threads) as downloader:
+            result, seconds = _timed(lambda: downloader.download("payload", os.path.join(workdir, "downloaded")))
+            if result is None:
+                raise RuntimeError("download failed")
+            return _s3_result(port, os.path.getsize(filename), seconds, agg)
+
+
+def _csv(workdir, opts):
+    filename, rows = fixtures.synthetic_csv_mb(os.path.join(workdir, "data.csv"), opts.size_mb, seed=opts.seed)
+    return filename, rows, os.path.getsize(filename)
+
+
+def gzc_serial(workdir, opts):
+    filename, rows, nbytes = _csv(workdir, opts)
+    out, seconds = _timed(lambda: utils.gzc(filename, level=6))
+    return {"seconds": seconds, "mb_per_s": nbytes / 2**20 / seconds, "ratio": os.path.getsize(out) / float(nbytes)}
+
+
+def gzc_parallel(workdir, opts):
+    filename, rows, nbytes = _csv(workdir, opts)
+    out, seconds = _timed(lambda: utils.gzc(filename, level=6, workers=opts.threads))
+    return {"seconds": seconds, "mb_per_s": nbytes / 2**20 / seconds, "ratio": os.path.getsize(out) / float(nbytes)}
+
+
+def split_csv_by_row(workdir, opts):
+    filename, rows, nbytes = _csv(workdir, opts)
+    files, seconds = _timed(lambda: utils.split_csv_by_row(filename, rows_per_file=-(-rows // 8), header_action="keep"))
+    return {"seconds": seconds, "mb_per_s": nbytes / 2**20 / seconds, "rows_per_s": rows / seconds, "files": len(files)}
+
+
+def split_csv(workdir, opts):
+    filename, rows, nbytes = _csv(workdir, opts)
+    files, seconds = _timed(lambda: utils.split_csv(filename, shards=8, header_action="keep", workers=opts.threads))
+    return {"seconds": seconds, "mb_per_s": nbytes / 2**20 / seconds, "rows_per_s": rows / seconds, "files": len(files)}
+
+
+@contextmanager
+def _bench_table(opts):
+    # imported here, so loading pandas does not count towards the peak RSS of the other scenarios
+    from botowraps import redshift
+
+    with local_postgres() as conf:
+        if conf is None:
+            raise Skip("no Postgres, set %s or put initdb on the PATH" % DSN_ENV)
+        conn = redshift.redshift_connection(conf)
+        try:
+            cur = conn.cursor()
+            cur.execute("""DROP TABLE IF EXISTS botowraps_bench;
+                CREATE TABLE botowraps_bench AS SELECT g AS id, DATE '2020-01-01' + (g %% 365) AS day, g * 0.5 AS amount,
+                md5(g::text) AS note, g %% 2 = 0 AS flag FROM generate_series(1, %(rows)s) g""", {"rows": opts.rows})
+            conn.commit()
+            yield redshift, conn
+            cur.execute("DROP TABLE botowraps_bench")
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def select(workdir, opts):
+    with _bench_table(opts) as (redshift, conn), MetricsAggregator() as agg:
+        df, seconds = _timed(lambda: redshift.select(conn, "SELECT * FROM botowraps_bench", max_rows=opts.rows))
+        event = agg.report()["select"]
+        return {"seconds": seconds, "rows_per_s": len(df) / seconds,
+                "execute": event["execute"]["total"], "fetch": event["fetch"]["total"]}
+
+
+def select_chunks(workdir, opts):
+    with _bench_table(opts) as (redshift, conn), MetricsAggregator() as agg:
+        chunksize = 50000
+        rows, seconds = _timed(lambda: sum(len(df) for df in redshift.select_chunks(conn, "SELECT * FROM botowraps_bench", chunksize=chunksize)))
+        conn.commit()  # named cursors live in a transaction
+        event = agg.report()["select_chunks"]
+        return {"seconds": seconds, "rows_per_s": rows / seconds,
+                "execute": event["execute"]["total"], "fetch": event["fetch"]["total"]}
+
+
+SCENARIOS = dict((func.__name__, func) for func in [
+    upload_thread, upload_process, upload_retry, upload_stream, upload_many, download,
+    gzc_serial, gzc_parallel, split_csv_by_row, split_csv, select, select_chunks,
+])
+
+
+def _run_child(name, opts):
+    # runs one scenario in this process and prints its result as JSON
+    workdir = tempfile.mkdtemp(prefix="botowraps_bench_")
+    try:
+        result = {"status": "ok"}
+        result.update(SCENARIOS[name](workdir, opts))
+    except Skip as exc:
+        result = {"status": "skipped", "reason": str(exc)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / float(scale)
+    result["peak_children_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / float(scale)
+    sys.stdout.write(json.dumps(result) + "\n")
+
+
+def _options(opts):
+    return ["--size-mb", str(opts.size_mb), "--rows", str(opts.rows), "--threads", str(opts.threads),
+            "--latency", str(opts.latency), "--fail-rate", str(opts.fail_rate), "--seed", str(opts.seed)]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="offline botowraps benchmarks")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run, repeatable (default all)")
+    parser.add_argument("--output", default=None, help="JSON results file (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--size-mb", type=float, default=64, help="payload size for S3 and file scenarios")
+    parser.add_argument("--rows", type=int, default=500000, help="table size for query scenarios")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added to each fake S3 request")
+    parser.add_argument("--fail-rate", type=float, default=0.1, help="part failure rate for upload_retry")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    opts = parser.parse_args(argv)
+
+    if opts.child is not None:
+        return _run_child(opts.child, opts)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for name in opts.scenario or sorted(SCENARIOS):
+        proc = subprocess.run([sys.executable, "-m", "benchmarks.run", "--child", name] + _options(opts),
+                              cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            results[name] = {"status": "failed", "error": proc.stderr.decode("utf-8", "replace").strip().splitlines()[-1:]}
+        else:
+            results[name] = json.loads(proc.stdout.decode("utf-8").strip().splitlines()[-1])
+        summary = dict((k, round(v, 3)) for k, v in results[name].items() if isinstance(v, float))
+        sys.stderr.write("%-18s %-8s %s\n" % (name, results[name]["status"], summary))
+
+    report = {
+        "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": dict((k, v) for k, v in vars(opts).items() if k not in ("child", "output", "scenario")),
+        "scenarios": results,
+    }
+    output = opts.output
+    if output is None:
+        output = os.path.join(root, "benchmarks", "results", report["timestamp"].replace(":", "") + ".json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as fo:
+        json.dump(report, fo, indent=2, sort_keys=True)
+    sys.stderr.write("results written to %s\n" % output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/local/bin/python3
+
+# standard lib imports
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import weakref
+import threading
+from collections import OrderedDict
+
+# local imports
+from botowraps.utils import _pyarrow
+
+
+# every ResultCache created, so writes to a table can invalidate cached results in all of them
+_caches = weakref.WeakSet()
+_caches_lock = threading.Lock()
+
+_TABLE_RE = re.compile(r'\b(?:from|join)\s+([\w."]+)', re.IGNORECASE)
+_LITERAL_RE = re.compile(r"('(?:[^']|'')*'?)")  # single-quoted string literals, '' escapes a quote
+
+
+def normalize_sql(sql):
+    """lowercases 'sql' and collapses whitespace outside string literals, so formatting differences map to the
+    same cache key while queries comparing different literals do not"""
+    parts = _LITERAL_RE.split(sql.strip().rstrip(";").strip())
+    # split() leaves the literals at odd positions, they are kept as written
+    return "".join(part if i % 2 else re.sub(r"\s+", " ", part.lower()) for i, part in enumerate(parts)).strip()
+
+
+def referenced_tables(sql):
+    """returns the set of table names following FROM or JOIN in 'sql', lowercased and unquoted"""
+    return set(name.replace('"', '').lower() for name in _TABLE_RE.findall(sql))
+
+
+def _same_table(a, b):
+    # 'schema.table' matches 'table' when either side has no schema
+    if "." in a and "." in b:
+        return a == b
+    return a.rpartition(".")[2] == b.rpartition(".")[2]
+
+
+def invalidate_table(table):
+    """drops results that read 'table' from every ResultCache. Called by redshift functions that write to a table"""
+    with _caches_lock:
+        caches = list(_caches)
+    for cache in caches:
+        cache.invalidate(table)
+
+
+class ResultCache(object):
+    """TTL and LRU cache of select results.
+
+    Entries are keyed by the normalized SQL, its parameters and the connection target, and expire after 'ttl'
+    seconds unless a per-entry ttl is given. The memory tier holds at most 'max_mb' of DataFrames, least recently
+    used first out. With 'disk_dir', entries pushed out of memory are written there as Feather files and read back
+    memory-mapped, up to 'disk_max_mb'. Entries are dropped when a table they read from is written by copy_from_s3,
+    delete, delete_by_date or upsert in this process"""
+
+    def __init__(self, ttl=300, max_mb=256, disk_dir=None, disk_max_mb=4096):
+        self.ttl = ttl
+        self.max_bytes = int(max_mb * 2**20)
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = int(disk_max_mb * 2**20)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (expires, nbytes, tables, df), least recently used first
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> (expires, nbytes, tables), least recently used first
+        self._disk_bytes = 0
+        self._generation = 0  # bumped by every invalidation, see begin()
+        self.hits = 0
+        self.misses = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+        with _caches_lock:
+            _caches.add(self)
+
+    @staticmethod
+    def key(sql, params=None, *extra):
+        """cache key for 'sql' with 'params', plus anything else the result depends on"""
+        raw = json.dumps([normalize_sql(sql), params, list(extra)], sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def begin(self):
+        """returns a token to pass to put(), so results computed across an invalidation are not stored"""
+        return self._generation
+
+    def get(self, key):
+        """returns the cached DataFrame for 'key' or None. Memory hits are copies, disk hits are memory-mapped"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[3].copy()
+                self._drop_memory(key)
+
+            entry = self._disk.get(key)
+            if entry is not None and entry[0] <= now:
+                self._drop_disk(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+            self.hits += 1
+
+        try:
+            return self._read(key)
+        except Exception as exc:
+            logging.warning("failed to read cached result %s: %s" % (key, exc))
+            with self._lock:
+                self._drop_disk(key)
+            return None
+
+    def put(self, key, df, tables=(), ttl=None, since=None):
+        """stores DataFrame 'df' under 'key'. 'tables' are the tables it was read from, for invalidation.
+        Nothing is stored if an invalidation happened after begin() returned 'since'"""
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        nbytes = int(df.memory_usage(deep=True).sum())
+        tables = frozenset(t.lower() for t in tables)
+        spill = []
+        with self._lock:
+            if since is not None and since != self._generation:
+                return False
+            generation = self._generation
+            if key in self._memory:
+                self._drop_memory(key)
+            if key in self._disk:
+                self._drop_disk(key)
+            if nbytes > self.max_bytes:
+                spill.append((key, (expires, nbytes, tables, df)))
+            else:
+                self._memory[key] = (expires, nbytes, tables, df)
+                self._memory_bytes += nbytes
+                while self._memory_bytes > self.max_bytes:
+                    old_key, old_entry = self._memory.popitem(last=False)
+                    self._memory_bytes -= old_entry[1]
+                    spill.append((old_key, old_entry))
+
+        if self.disk_dir is not None:
+            for old_key, old_entry in spill:
+                if old_entry[0] > time.time():
+                    self._spill(old_key, old_entry, generation)
+        return True
+
+    def invalidate(self, table=None):
+        """drops entries that read 'table', or every entry if 'table' is None"""
+        with self._lock:
+            self._generation += 1
+            for key, entry in list(self._memory.items()):
+                if table is None or any(_same_table(table.lower(), t) for t in entry[2]):
+                    self._drop_memory(key)
+            for key, entry in list(self._disk.items()):
+                if table is None or any(_same_table(table.lower(), t) for t in entry[2]):
+                    self._drop_disk(key)
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory), "memory_bytes": self._memory_bytes,
+                    "disk_entries": len(self._disk), "disk_bytes": self._disk_bytes}
+
+    # memory tier, called with the lock held
+    def _drop_memory(self, key):
+        entry = self._memory.pop(key)
+        self._memory_bytes -= entry[1]
+
+    # disk tier
+    def _path(self, key, suffix):
+        return os.path.join(self.disk_dir, key + suffix)
+
+    def _spill(self, key, entry, generation):
+        expires, nbytes, tables, df = entry
+        pa = _pyarrow()
+        try:
+            # feather needs string column names, the original names are kept in the metadata file
+            table = pa.Table.from_pandas(df.set_axis([str(c) for c in df.columns], axis=1), preserve_index=False)
+            pa.feather.write_feather(table, self._path(key, ".feather.tmp"), compression="uncompressed")  # uncompressed files can be memory-mapped
+            os.replace(self._path(key, ".feather.tmp"), self._path(key, ".feather"))
+            size = os.path.getsize(self._path(key, ".feather"))
+            with open(self._path(key, ".json"), "w") as fo:
+                json.dump({"expires": expires, "tables": sorted(tables), "columns": list(df.columns)}, fo, default=str)
+        except Exception as exc:
+            logging.warning("failed to spill cached result %s to disk: %s" % (key, exc))
+            return
+
+        with self._lock:
+            if key in self._disk:
+                self._drop_disk(key)
+            self._disk[key] = (expires, size, tables)
+            self._disk_bytes += size
+            if generation != self._generation:  # invalidated while writing, the entry may be stale
+                self._drop_disk(key)
+                return
+            while self._disk_bytes > self.disk_max_bytes and self._disk:
+                self._drop_disk(next(iter(self._disk)))
+
+    def _read(self, key):
+        pa = _pyarrow()
+        with open(self._path(key, ".json")) as fi:
+            columns = json.load(fi)["columns"]
+        df = pa.feather.read_table(self._path(key, ".feather"), memory_map=True).to_pandas()
+        df.columns = columns
+        return df
+
+    def _drop_disk(self, key):
+        # called with the lock held
+        entry = self._disk.pop(key)
+        self._disk_bytes -= entry[1]
+        for suffix in (".feather", ".json"):
+            try:
+                os.unlink(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def _load_disk_index(self):
+        # picks up unexpired entries left in disk_dir by earlier runs, oldest first in LRU order
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            try:
+                with open(self._path(key, ".json")) as fi:
+                    meta = json.load(fi)
+                size = os.path.getsize(self._path(key, ".feather"))
+            except (OSError, ValueError):
+                continue
+            entries.append((os.path.getmtime(self._path(key, ".json")), key, meta, size))
+        for _, key, meta, size in sorted(entries):
+            self._disk[key] = (meta["expires"], size, frozenset(meta["tables"]))
+            self._disk_bytes += size
+            if meta["expires"] <= now:
+                self._drop_disk(key)
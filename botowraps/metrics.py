@@ -0,0 +1,107 @@
+#!/usr/local/bin/python3
+
+# standard lib imports
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+
+# listeners called as listener(name, fields) for every event. Empty by default, in which case emit returns at once
+_listeners = []
+_listeners_lock = threading.Lock()
+
+
+def add_listener(listener):
+    """registers 'listener', called as listener(name, fields) for every event emitted. Returns the listener"""
+    global _listeners
+    with _listeners_lock:
+        _listeners = _listeners + [listener]  # copy on write, emit iterates without locking
+    return listener
+
+
+def remove_listener(listener):
+    global _listeners
+    with _listeners_lock:
+        _listeners = [x for x in _listeners if x is not listener]
+
+
+def emit(name, **fields):
+    """sends event 'name' with its 'fields' to every listener. A failing listener is logged and skipped"""
+    if not _listeners:
+        return
+    for listener in _listeners:
+        try:
+            listener(name, fields)
+        except Exception as exc:
+            logging.warning("metrics listener failed on %s event: %s" % (name, exc))
+
+
+@contextmanager
+def capture():
+    """collects events emitted in this process into a list of (name, fields) instead of sending them to listeners.
+    Used in worker processes, whose events are sent back and emitted again in the parent"""
+    global _listeners
+    events = []
+    with _listeners_lock:
+        saved, _listeners = _listeners, [lambda name, fields: events.append((name, fields))]
+    try:
+        yield events
+    finally:
+        with _listeners_lock:
+            _listeners = saved
+
+
+class MetricsAggregator(object):
+    """in-memory listener that keeps the numeric fields of every event and reports count, mean, max and percentiles.
+    At most 'max_samples' values are kept per field (a uniform reservoir sample), so memory stays bounded.
+    Use as a context manager to register it for the duration of a block"""
+
+    def __init__(self, max_samples=10000, seed=None):
+        self.max_samples = max_samples
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}  # event name -> events seen
+            self._fields = {}  # (event name, field) -> [values seen, total, max, samples]
+
+    def __call__(self, name, fields):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+            for field, value in fields.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                stats = self._fields.get((name, field))
+                if stats is None:
+                    stats = self._fields[(name, field)] = [0, 0.0, value, []]
+                stats[0] += 1
+                stats[1] += value
+                stats[2] = max(stats[2], value)
+                if len(stats[3]) < self.max_samples:
+                    stats[3].append(value)
+                else:
+                    slot = self._random.randrange(stats[0])
+                    if slot < self.max_samples:
+                        stats[3][slot] = value
+
+    def __enter__(self):
+        return add_listener(self)
+
+    def __exit__(self, *exc):
+        remove_listener(self)
+
+    def report(self, percentiles=(50, 90, 99)):
+        """returns {event: {"count": n, field: {"mean", "max", "total", "p50", ...}}}"""
+        with self._lock:
+            result = dict((name, {"count": count}) for name, count in self._counts.items())
+            for (name, field), (seen, total, largest, samples) in self._fields.items():
+                samples = sorted(samples)
+                stats = {"mean": total / seen, "max": largest, "total": total}
+                for p in percentiles:
+                    # nearest-rank percentile
+                    stats["p%s" % p] = samples[max(0, -(-p * len(samples) // 100) - 1)]
+                result[name][field] = stats
+        return result
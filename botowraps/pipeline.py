@@ -0,0 +1,211 @@
+#!/usr/local/bin/python3
+
+# standard lib imports
+import time
+import gzip
+import queue
+import logging
+import threading
+from collections import defaultdict
+
+# third party lib imports
+import pandas as pd
+
+# local imports
+from botowraps.s3 import S3Uploader
+from botowraps.utils import _line_blocks
+from botowraps.redshift import copy_from_manifest
+
+
+_DONE = object()  # end of stream marker passed between stages
+
+
+class _Pipeline(object):
+    """bounded queues, stop flag and per-stage timers shared by the bulk_load stages"""
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.error = None
+        self.timings = defaultdict(float)  # stage name -> seconds spent working
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def queue(self):
+        return queue.Queue(maxsize=self.queue_size)
+
+    def fail(self, exc):
+        with self._lock:
+            if self.error is None:
+                self.error = exc
+        self.stop.set()
+
+    def timed(self, stage, seconds):
+        with self._lock:
+            self.timings[stage] += seconds
+
+    def put(self, q, item):
+        # gives up when another stage failed, so a full queue cannot block the pipeline forever
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def start(self, target, *args):
+        thread = threading.Thread(target=self._run, args=(target,) + args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _run(self, target, *args):
+        try:
+            target(*args)
+        except Exception as exc:
+            logging.warning("bulk_load stage failed: %s" % exc)
+            self.fail(exc)
+
+    def workers(self, stage, func, q_in, q_out, count):
+        """runs 'count' threads applying 'func' to items of q_in, the last one to finish passes _DONE downstream"""
+        remaining = [count]
+
+        def work():
+            try:
+                while True:
+                    item = self.get(q_in)
+                    if item is _DONE:
+                        self.put(q_in, _DONE)  # let sibling workers see the end too
+                        return
+                    start = time.time()
+                    result = func(item)
+                    self.timed(stage, time.time() - start)
+                    if q_out is not None and not self.put(q_out, result):
+                        return
+            finally:
+                with self._lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and q_out is not None:
+                    self.put(q_out, _DONE)
+
+        for _ in range(count):
+            self.start(work)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _serialize(source, delimiter, header, serialize_rows, block_mb):
+    """generator of (raw bytes, rows) blocks ending on row boundaries, from a DataFrame or a local file"""
+    if isinstance(source, pd.DataFrame):
+        for i in range(0, len(source), serialize_rows):
+            chunk = source.iloc[i:i + serialize_rows]
+            yield chunk.to_csv(index=False, header=False, sep=delimiter).encode("utf-8"), len(chunk)
+    else:
+        with open(source, "rb") as fi:
+            if header:
+                fi.readline()  # shards are loaded without IGNOREHEADER, so the header row is dropped once here
+            for block in _line_blocks(fi, int(block_mb * 2**20)):
+                yield block, block.count(b"\n")
+
+
+def bulk_load(conn, source, table, s3conf, bucketname, prefix, shard_size_mb=64, compress=True, level=6, delimiter=",",
+              header=False, serialize_rows=100000, block_mb=4, compress_workers=4, upload_workers=4, queue_size=4, **copy_args):
+    """loads a DataFrame or a local delimited file into 'table' as one streaming pipeline:
+    serialize -> shard -> compress -> upload -> COPY.
+
+    Rows are serialized in blocks and grouped into shards of about 'shard_size_mb', each of which becomes one
+    S3 key under 'prefix'. Shards are gzipped by 'compress_workers' threads (as one gzip member per block) and
+    uploaded by 'upload_workers' threads while later shards are still being produced. Stages are connected by
+    queues holding at most 'queue_size' shards, which bounds memory use. Once every shard is uploaded, one
+    COPY ... MANIFEST loads them all in a single transaction. 'header' drops the first row of a file source.
+    Other keyword arguments are passed to copy_from_s3.
+
+    Returns a dict with the uploaded 'keys', 'rows', 'raw_bytes', 'uploaded_bytes' and per-stage 'timings' in
+    seconds (time spent working in each stage, summed over its workers, plus 'total' wall time)"""
+    start_time = time.time()
+    pipeline = _Pipeline(queue_size)
+    to_compress = pipeline.queue()
+    to_upload = pipeline.queue()
+    uploaded = []  # (keyname, content_length)
+    uploaded_lock = threading.Lock()
+    counts = defaultdict(int)
+    shard_size = int(shard_size_mb * 2**20)
+    suffix = ".gz" if compress else ""
+    uploader = S3Uploader(s3conf, bucketname, threads=upload_workers, executor="thread")
+
+    def produce():
+        shard, shard_bytes, shard_num = [], 0, 0
+        blocks = _serialize(source, delimiter, header, serialize_rows, block_mb)
+        while True:
+            start = time.time()
+            item = next(blocks, None)
+            pipeline.timed("serialize", time.time() - start)
+            if item is None or pipeline.stop.is_set():
+                break
+            block, rows = item
+            counts["rows"] += rows
+            counts["raw_bytes"] += len(block)
+
+            start = time.time()
+            shard.append(block)
+            shard_bytes += len(block)
+            if shard_bytes >= shard_size:
+                shard_num += 1
+                pipeline.put(to_compress, (shard_num, shard))
+                shard, shard_bytes = [], 0
+            pipeline.timed("shard", time.time() - start)
+        if shard:
+            pipeline.put(to_compress, (shard_num + 1, shard))
+        pipeline.put(to_compress, _DONE)
+
+    def compress_shard(item):
+        shard_num, blocks = item
+        if compress:
+            blocks = [gzip.compress(block, level) for block in blocks]  # concatenated members form one valid gzip file
+        return shard_num, blocks
+
+    def upload_shard(item):
+        shard_num, blocks = item
+        keyname = "%s/part_%05d%s" % (prefix.rstrip("/"), shard_num, suffix)
+        if uploader.upload_stream(iter(blocks), keyname) is None:
+            raise IOError("failed to upload %s" % keyname)
+        with uploaded_lock:
+            uploaded.append((keyname, sum(len(block) for block in blocks)))
+
+    try:
+        pipeline.start(produce)
+        pipeline.workers("compress", compress_shard, to_compress, to_upload, compress_workers)
+        pipeline.workers("upload", upload_shard, to_upload, None, upload_workers)
+        pipeline.join()
+    finally:
+        uploader.close()
+
+    uploaded.sort()
+    keys = [keyname for keyname, _ in uploaded]
+    result = {"keys": keys, "rows": counts["rows"], "raw_bytes": counts["raw_bytes"],
+              "uploaded_bytes": sum(size for _, size in uploaded)}
+    if keys:
+        start = time.time()
+        if compress:
+            copy_args["compression"] = "GZIP"
+        copy_from_manifest(conn, s3conf, bucketname, uploaded, table, "%s/manifest" % prefix.rstrip("/"),
+                           delimiter=delimiter, **copy_args)
+        pipeline.timed("copy", time.time() - start)
+
+    result["timings"] = dict(pipeline.timings)
+    result["timings"]["total"] = time.time() - start_time
+    logging.info("bulk_load of %s: %s" % (table, result["timings"]))
+    return result
@@ -3,18 +3,36 @@
 # standard lib imports
 import os
 import sys
+import csv
 import json
 import re
+import time
+import uuid
 import logging
+import threading
+import functools
+import inspect
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 from datetime import datetime, timedelta
 
 # third party lib imports
 import pandas as pd
 import psycopg2 as pg2
 from psycopg2.extensions import AsIs
+from psycopg2.extras import execute_values
 
+# local imports
+from botowraps import metrics
+from botowraps.cache import ResultCache, invalidate_table, referenced_tables
+from botowraps.s3 import S3Uploader, S3Downloader
+from botowraps.utils import read_parquet
 
-def redshift_connection(conf):
+
+def _load_conf(conf):
     # assuming conf as json file or dict with keys 'host','user','password','port','database'
     if type(conf) == str:
         with open(conf, 'r') as conf:
@@ -23,12 +41,192 @@ def redshift_connection(conf):
         pass
     else:
         raise ValueError("conf must be the path to a file with valid JSON or a python dict object containing the keys [ 'host','user','password','port','database' ]")
-    return pg2.connect(**conf)
+    return conf
+
+
+def redshift_connection(conf):
+    return pg2.connect(**_load_conf(conf))
+
+
+class PoolError(Exception):
+    pass
+
+
+class RedshiftPool(object):
+    """thread-safe pool of redshift connections. Connections are health-checked on checkout and
+    recycled once older than 'max_age' seconds or idle for longer than 'max_idle' seconds"""
+
+    def __init__(self, conf, minconn=1, maxconn=10, max_age=3600, max_idle=300, timeout=None):
+        if minconn < 0 or maxconn <= 0 or minconn > maxconn:
+            raise ValueError("pool sizes must satisfy 0 <= minconn <= maxconn and maxconn > 0")
+        self.conf = _load_conf(conf)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_age = max_age  # seconds a connection may live before it is closed and replaced
+        self.max_idle = max_idle  # seconds a connection may sit unused in the pool
+        self.timeout = timeout  # seconds to wait for a free connection, None waits forever
+
+        self._cond = threading.Condition()
+        self._idle = []  # stack of (conn, created, last_used), most recently used last
+        self._borrowed = {}  # id(conn) -> created
+        self._size = 0  # idle + borrowed connections
+        self._closed = False
+
+        for _ in range(minconn):
+            self._idle.append((pg2.connect(**self.conf), time.time(), time.time()))
+            self._size += 1
+
+    def _is_healthy(self, conn, created, last_used):
+        now = time.time()
+        if conn.closed or now - created > self.max_age or now - last_used > self.max_idle:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except pg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except pg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        """checks out a healthy connection, opening one if the pool is below maxconn"""
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            entry = None
+            with self._cond:
+                if self._closed:
+                    raise PoolError("pool is closed")
+                if self._idle:
+                    entry = self._idle.pop()
+                elif self._size < self.maxconn:
+                    self._size += 1
+                else:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise PoolError("timed out waiting for a connection, all {} connections in use".format(self.maxconn))
+                    self._cond.wait(remaining)
+                    continue
+
+            if entry is None:  # room to grow the pool
+                try:
+                    conn = pg2.connect(**self.conf)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                created = time.time()
+            else:
+                conn, created, last_used = entry
+                if not self._is_healthy(conn, created, last_used):
+                    logging.info("Discarding stale redshift connection")
+                    self._discard(conn)
+                    continue
+
+            with self._cond:
+                self._borrowed[id(conn)] = created
+            return conn
+
+    def putconn(self, conn, close=False):
+        """returns a connection to the pool, rolling back any open transaction"""
+        with self._cond:
+            created = self._borrowed.pop(id(conn))
+
+        if not (close or conn.closed or self._closed):
+            try:
+                conn.rollback()
+            except pg2.Error:
+                close = True
+
+        if close or conn.closed or self._closed or time.time() - created > self.max_age:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, created, time.time()))
+            self._cond.notify()
+        self._reap()
+
+    def _reap(self):
+        # close connections idle longer than max_idle, keeping at least minconn open
+        now = time.time()
+        stale = []
+        with self._cond:
+            while self._idle and self._size - len(stale) > self.minconn and now - self._idle[0][2] > self.max_idle:
+                stale.append(self._idle.pop(0)[0])
+        for conn in stale:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """context manager that borrows a connection for the duration of the block"""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def redshift_pool(conf, **kwargs):
+    """returns the shared RedshiftPool for 'conf', creating it on first use. kwargs are passed to RedshiftPool"""
+    conf = _load_conf(conf)
+    pool_key = json.dumps(conf, sort_keys=True)
+    with _pools_lock:
+        pool = _pools.get(pool_key)
+        if pool is None or pool._closed:
+            pool = _pools[pool_key] = RedshiftPool(conf, **kwargs)
+    return pool
+
+
+@contextmanager
+def _borrow(conn):
+    """yields a raw connection from either a connection or a RedshiftPool"""
+    if isinstance(conn, RedshiftPool):
+        with conn.connection() as pooled:
+            yield pooled
+    else:
+        yield conn
+
 
+def _accepts_pool(func):
+    """lets 'func' take a RedshiftPool as its 'conn' argument, holding one connection for the whole call"""
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(conn, *args, **kwargs):
+            with _borrow(conn) as raw:
+                yield from func(raw, *args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(conn, *args, **kwargs):
+            with _borrow(conn) as raw:
+                return func(raw, *args, **kwargs)
+    return wrapper
 
-def select(conn, sql, to_df=True, header=True, max_rows=100000):
 
-    """Executes SELECT statements, and outputs to nested list or DataFrame"""
+def _check_select(sql):
+    """raises ValueError unless 'sql' is a single read-only SELECT statement"""
 
     # lowercase the SQL statement to make parsing easier. This does not affect execution in Redshift.
     sql = sql.lower()
@@ -43,60 +241,190 @@ def select(conn, sql, to_df=True, header=True, max_rows=100000):
     if illegal_ops_match:
         raise ValueError("'sql' contains illegal operation: {}. This function can only execute SELECT queries.".format(illegal_ops_match.group(0).upper()))
 
-    # get table name and column names from 'sql'
-    table_re = re.compile(r'(?<=from )[A-Za-z0-9\_]+(?=^|\s|\;|$)')
-    column_re = re.compile(r'(?<=select )[A-Za-z0-9\s\_*\\(\),]+(?= from)')
+    return sql
+
+
+# maps postgres type OIDs reported in cursor.description to pandas dtypes
+_PG_DTYPES = {
+    16: "bool",  # boolean
+    20: "int64",  # bigint
+    21: "int64",  # smallint
+    23: "int64",  # integer
+    700: "float64",  # real
+    701: "float64",  # double precision
+    1700: "float64",  # numeric / decimal
+    1082: "datetime64[ns]",  # date
+    1114: "datetime64[ns]",  # timestamp
+    1184: "datetime64[ns, UTC]",  # timestamptz
+}
+
+# (dsn, schema, table) -> (time fetched, [(column, type), ...])
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+
+@_accepts_pool
+def table_columns(conn, table, schema=None, ttl=300):
+    """returns list of (column, type) tuples for 'table' from pg_table_def, cached per connection target for 'ttl' seconds"""
+
+    cache_key = (conn.dsn, schema, table)
+    now = time.time()
+    with _schema_cache_lock:
+        cached = _schema_cache.get(cache_key)
+    if cached is not None and now - cached[0] < ttl:
+        return cached[1]
+
+    sql = """SELECT "column", type FROM pg_table_def WHERE tablename=%(table)s"""
+    data = {"table": table}
+    if schema is not None:
+        sql += " AND schemaname=%(schema)s"
+        data["schema"] = schema
+
+    cur = conn.cursor()
+    cur.execute(sql, data)
+    columns = [(x[0], x[1]) for x in cur.fetchall()]
+    cur.close()
+
+    with _schema_cache_lock:
+        _schema_cache[cache_key] = (now, columns)
+    return columns
+
+
+def clear_schema_cache(table=None):
+    """drops cached table_columns results for 'table', or for all tables if 'table' is None"""
+    with _schema_cache_lock:
+        for cache_key in list(_schema_cache):
+            if table is None or cache_key[2] == table:
+                del _schema_cache[cache_key]
+
 
-    tmatch = table_re.search(sql)
-    if tmatch:
-        table = tmatch.group(0)
+def _column_series(values, type_code):
+    """builds a typed pandas Series from one column of fetched values"""
+    dtype = _PG_DTYPES.get(type_code)
+    if dtype is None:
+        return pd.Series(values)
+
+    if dtype.startswith("datetime64"):
+        return pd.Series(pd.to_datetime(list(values), utc=dtype.endswith("UTC]")))
+
+    if any(v is None for v in values):
+        if dtype == "bool":  # bools with NULLs would silently become False
+            return pd.Series(values, dtype=object)
+        dtype = "float64"  # ints with NULLs are stored as float with NaN, as pandas does
+
+    return pd.Series(values, dtype=dtype)
+
+
+def _rows_to_frame(rows, description, header=True):
+    """converts fetched rows to a DataFrame with dtypes taken from the cursor description"""
+    if rows:
+        columns = list(zip(*rows))
     else:
-        raise ValueError("No table name found in 'sql' argument")
-
-    cmatch = column_re.search(sql)
-    columns = []
-    if cmatch:
-        csplit = cmatch.group(0).split(',')
-        for col in csplit:
-            is_wildcard = col.replace(' ', '') == "*"
-            # if there's a wildcard in the columns, query pg_table_def to get column names and order
-            if is_wildcard:
-                cur = conn.cursor()
-                cur.execute("""SELECT "column" FROM pg_table_def WHERE tablename=%(table)s""", {"table": table})
-                columns += [x[0] for x in cur.fetchall()]
-                cur.close()
-            else:
-                # if columns are renamed in query using the 'AS' operation, use the string given after 'AS'.
-                # Otherwise, use column name as is
-                as_split = col.split(' as ')
-                if len(as_split) > 1:  # this can only be greater than 1 if there is an 'AS' operation
-                    columns.append(as_split[-1].replace(' ', ''))
-                else:
-                    columns.append(col.replace(' ', ''))
+        columns = [() for _ in description]
+
+    df = pd.DataFrame({i: _column_series(values, desc[1]) for i, (values, desc) in enumerate(zip(columns, description))})
+    if header:
+        df.columns = [desc[0] for desc in description]
+    return df
+
+
+@_accepts_pool
+def select(conn, sql, to_df=True, header=True, max_rows=100000, params=None, cache=None, ttl=None):
+
+    """Executes SELECT statements, and outputs to nested list or DataFrame. 'params' are passed to the query.
+    With a ResultCache as 'cache', DataFrame results are served from and stored in it, for 'ttl' seconds if given"""
+
+    _check_select(sql)  # validates a lowercased copy, placeholders and literals are executed as written
+
+    if cache is not None and to_df:
+        cache_key = ResultCache.key(sql, params, conn.dsn, header)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if len(cached) > max_rows:  # the entry may come from a call with a higher max_rows
+                raise ValueError('Query resulted in too many rows of data to output: {}. Increase max_rows parameter ({}) and try again.'.format(len(cached), max_rows))
+            metrics.emit("select", rows=len(cached), execute=0.0, fetch=0.0, cached=True)
+            return cached
+        generation = cache.begin()
 
     cur = conn.cursor()
-    cur.execute(sql)
+    start = time.time()
+    cur.execute(sql, params)
+    executed = time.time()
     if cur.rowcount <= max_rows:
 
-        data = [list(x) for x in cur.fetchall()]
+        rows = cur.fetchall()
+        metrics.emit("select", rows=len(rows), execute=executed - start, fetch=time.time() - executed, cached=False)
 
         if not to_df:  # return as list of lists
+            data = [list(x) for x in rows]
             if header:
-                data = columns + data
+                data = [[desc[0] for desc in cur.description]] + data
             return data
-        else:  # return as pandas DataFrame
-            if header:
-                df = pd.DataFrame(data, columns=columns)
-            else:
-                df = pd.DataFrame(data)
-            return(df)
+        else:  # return as pandas DataFrame, column names and dtypes come from the cursor description
+            df = _rows_to_frame(rows, cur.description, header=header)
+            if cache is not None:
+                cache.put(cache_key, df, referenced_tables(sql), ttl=ttl, since=generation)
+                return df.copy()  # the cached frame must not change with the caller's copy
+            return df
     else:
         raise ValueError('Query resulted in too many rows of data to output: {}. Increase max_rows parameter ({}) and try again.'.format(cur.rowcount, max_rows))
     cur.close()
     return None
 
 
-def copy_from_s3(conn, s3conf, bucketname, keyname, table, delimiter=",", quote_char="\"", escape=False, na_string=None, header_rows=0, date_format="auto", compression=None, explicit_ids=False, manifest=False, not_run=False):
+@_accepts_pool
+def select_chunks(conn, sql, chunksize=10000, to_df=True, header=True, itersize=None):
+
+    """Generator that executes a SELECT statement on a server-side cursor and yields batches of at most 'chunksize' rows,
+    as DataFrames or lists of lists. Only one batch is held in memory at a time, so result size is unbounded"""
+
+    if chunksize <= 0:
+        raise ValueError("chunksize must be > 0")
+
+    _check_select(sql)
+
+    # named cursors are declared server-side, rows are only transferred as they are fetched
+    cur = conn.cursor(name="botowraps_{}".format(uuid.uuid4().hex))
+    cur.itersize = chunksize if itersize is None else itersize  # rows per network round-trip
+    start = time.time()
+    execute = fetch = 0.0
+    total = 0
+    try:
+        cur.execute(sql)
+        execute = time.time() - start
+        rows_iter = iter(cur)
+        while True:
+            fetch_start = time.time()
+            rows = list(islice(rows_iter, chunksize))
+            fetch += time.time() - fetch_start
+            if not rows:
+                break
+            total += len(rows)
+            # named cursors only have a description once rows have been fetched
+            if to_df:
+                yield _rows_to_frame(rows, cur.description, header=header)
+            elif header:
+                yield [[desc[0] for desc in cur.description]] + [list(x) for x in rows]
+            else:
+                yield [list(x) for x in rows]
+    finally:
+        cur.close()
+        metrics.emit("select_chunks", rows=total, execute=execute, fetch=fetch)
+
+
+def _is_parquet(file_format):
+    """checks the 'file_format' argument of copy_from_s3 and unload_into_s3, None is delimited text"""
+    if file_format is None:
+        return False
+    if file_format.upper() != "PARQUET":
+        raise ValueError("file_format must be None or 'PARQUET'")
+    return True
+
+
+@_accepts_pool
+def copy_from_s3(conn, s3conf, bucketname, keyname, table, delimiter=",", quote_char="\"", escape=False, na_string=None, header_rows=0, date_format="auto", compression=None, explicit_ids=False, manifest=False, not_run=False, commit=True, file_format=None):
+    """loads S3 data into 'table'. With file_format="PARQUET" the text format options
+    (delimiter, quoting, NULL string, header, date format and compression) are left out"""
 
     if isinstance(s3conf, str):
         with open(s3conf) as fi:
@@ -114,6 +442,12 @@ def copy_from_s3(conn, s3conf, bucketname, keyname, table, delimiter=",", quote_
         "file_location": AsIs(os.path.join(bucketname, keyname))
     }
 
+    parquet = _is_parquet(file_format)
+    if parquet:
+        sql += "FORMAT AS PARQUET "
+        na_string = delimiter = header_rows = date_format = quote_char = compression = None
+        escape = False
+
     if na_string is not None:
         sql += "NULL %(na_string)s "
         data["na_string"] = na_string
@@ -125,7 +459,7 @@ def copy_from_s3(conn, s3conf, bucketname, keyname, table, delimiter=",", quote_
     if escape:
         sql += "ESCAPE "
 
-    if header_rows > 0:
+    if header_rows:
         sql += "IGNOREHEADER %(header_rows)s "
         data["header_rows"] = header_rows
 
@@ -151,12 +485,28 @@ def copy_from_s3(conn, s3conf, bucketname, keyname, table, delimiter=",", quote_
     if not_run:
         return cur.mogrify(sql, data)
     else:
+        start = time.time()
         cur.execute(sql, data)
-        conn.commit()
+        if commit:  # commit=False leaves the load in the caller's transaction
+            conn.commit()
+            invalidate_table(table)
+        metrics.emit("copy", table=table, rows=cur.rowcount, seconds=time.time() - start)
         return True
 
 
-def unload_into_s3(conn, s3conf, bucketname, keyname, table=None, select_statement=None, select_data={}, delimiter=",", escape=False, na_string=None, compression=None, allow_overwrite=False, parallel=True, not_run=False, manifest=False):
+@_accepts_pool
+def copy_from_manifest(conn, s3conf, bucketname, keys, table, manifest_keyname, mandatory=True, **copy_args):
+    """writes a COPY manifest for 'keys' (keynames or (keyname, content_length) tuples) to 'manifest_keyname' and
+    loads every file with a single COPY ... MANIFEST, so all slices load in parallel in one transaction.
+    Other keyword arguments are passed to copy_from_s3"""
+    S3Uploader(s3conf, bucketname).upload_manifest(keys, manifest_keyname, mandatory=mandatory)
+    return copy_from_s3(conn, s3conf, bucketname, manifest_keyname, table, manifest=True, **copy_args)
+
+
+@_accepts_pool
+def unload_into_s3(conn, s3conf, bucketname, keyname, table=None, select_statement=None, select_data={}, delimiter=",", escape=False, na_string=None, compression=None, allow_overwrite=False, parallel=True, not_run=False, manifest=False, file_format=None):
+    """unloads 'table' or 'select_statement' to S3 under 'keyname'. With file_format="PARQUET" the files are
+    written as Parquet and the text format options (NULL string, delimiter, escape and compression) are left out"""
 
     cur = conn.cursor()
 
@@ -184,6 +534,11 @@ def unload_into_s3(conn, s3conf, bucketname, keyname, table=None, select_stateme
         "file_location": AsIs(os.path.join(bucketname, keyname))
     }
 
+    if _is_parquet(file_format):
+        sql += "FORMAT AS PARQUET "
+        na_string = delimiter = compression = None
+        escape = False
+
     if na_string is not None:
         sql += "NULL %(na_string)s "
         data["na_string"] = na_string
@@ -213,43 +568,195 @@ def unload_into_s3(conn, s3conf, bucketname, keyname, table=None, select_stateme
     if not_run:
         return cur.mogrify(sql, data)
     else:
+        start = time.time()
         cur.execute(sql, data)
         conn.commit()
+        metrics.emit("unload", keyname=keyname, seconds=time.time() - start)
         return True
 
 
-def delete(conn, table, not_run=False, params={}):
-    """method to delete data from table. Params are 'AND'ed """
-
-    data = {
-        "table": AsIs(table),
-    }
+_UNLOAD_NULL = "__BOTOWRAPS_NULL__"  # marks NULLs in unloaded files, so they stay distinct from empty strings
+
+
+def _read_unloaded(filename, description, delimiter):
+    """parses one unloaded GZIP part into a DataFrame. Numbers are parsed by the C parser, other columns are read as strings"""
+    names = [desc[0] for desc in description]
+    dtypes = {}
+    for desc in description:
+        dtype = _PG_DTYPES.get(desc[1])
+        if dtype == "float64":
+            dtypes[desc[0]] = "float64"
+        elif dtype != "int64":  # ints are inferred, so NULLs give float64 as in select
+            dtypes[desc[0]] = object
+    try:
+        return pd.read_csv(filename, sep=delimiter, header=None, names=names, compression="gzip", quoting=csv.QUOTE_NONE,
+                           escapechar="\\", na_values=[_UNLOAD_NULL], keep_default_na=False, dtype=dtypes, engine="c")
+    except pd.errors.EmptyDataError:  # slices without rows write empty parts
+        return None
+
+
+def _type_unloaded(df, description):
+    """converts unloaded string columns to the dtypes of the cursor description, with the NULL handling of select"""
+    for name, desc in zip(df.columns, description):
+        dtype = _PG_DTYPES.get(desc[1])
+        column = df[name]
+        if dtype is None:
+            continue
+        elif dtype.startswith("datetime64"):
+            df[name] = pd.to_datetime(column, utc=dtype.endswith("UTC]"))
+        elif dtype == "bool":
+            column = column.map({"t": True, "f": False})
+            df[name] = column.astype(object) if column.isnull().any() else column.astype(bool)
+        elif column.dtype == object:  # only for frames without rows
+            df[name] = column.astype("float64")
+    return df
+
+
+@_accepts_pool
+def unload_to_dataframe(conn, sql, s3conf, bucketname, prefix="botowraps_unload", params=None, threads=8, delimiter="|", file_format=None):
+    """runs SELECT 'sql' through a parallel UNLOAD and returns the result as a DataFrame. Much faster than select for
+    large results, since every slice writes its own GZIP part instead of streaming rows through the leader node.
+
+    Column names and dtypes come from a LIMIT 0 run of the query. Parts are written under a unique scratch key below
+    'prefix', downloaded concurrently, parsed into DataFrames on 'threads' threads and concatenated.
+    With file_format="PARQUET" the parts are Parquet files, which are smaller and carry their own types.
+    The scratch keys and local files are removed afterwards"""
+
+    sql = sql.strip().rstrip("; \t\r\n")  # the query is wrapped in a subquery and in UNLOAD ('...'), a trailing ';' breaks both
+    _check_select(sql)
+
+    params = params or None  # psycopg2 only leaves a literal '%' alone without params, probe and UNLOAD must agree
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM (%s) botowraps_q LIMIT 0" % sql, params)
+    description = cur.description
+    names = [desc[0] for desc in description]
+    cur.close()
 
-    sql = """DELETE FROM %(table)s"""
-    where = []
+    scratch = "%s/%s/" % (prefix.rstrip("/"), uuid.uuid4().hex)
+    target_dir = tempfile.mkdtemp(prefix="botowraps_unload_")
+    downloader = S3Downloader(s3conf, bucketname, threads=threads)
+    parquet = _is_parquet(file_format)
+    try:
+        if parquet:
+            unload_into_s3(conn, s3conf, bucketname, scratch + "part_", select_statement=sql, select_data=params,
+                           allow_overwrite=True, parallel=True, manifest=True, file_format=file_format)
+        else:
+            unload_into_s3(conn, s3conf, bucketname, scratch + "part_", select_statement=sql, select_data=params, delimiter=delimiter,
+                           escape=True, na_string=_UNLOAD_NULL, compression="GZIP", allow_overwrite=True, parallel=True, manifest=True)
+
+        start = time.time()
+        filenames = downloader.download_manifest(scratch + "part_manifest", target_dir)
+        if None in filenames:
+            raise IOError("failed to download %s of %s unloaded parts" % (filenames.count(None), len(filenames)))
+        download = time.time() - start
+        logging.info("Downloaded %s unloaded parts in %.1fs" % (len(filenames), download))
+
+        start = time.time()
+        if parquet:
+            df = read_parquet(filenames, workers=threads) if filenames else pd.DataFrame(columns=names)
+            logging.info("Parsed %s rows in %.1fs" % (len(df), time.time() - start))
+            metrics.emit("unload_to_dataframe", rows=len(df), parts=len(filenames), download=download, parse=time.time() - start)
+            return df
+        with ThreadPoolExecutor(max_workers=threads) as pool:  # the C parser releases the GIL while tokenizing
+            frames = list(pool.map(lambda filename: _read_unloaded(filename, description, delimiter), filenames))
+        frames = [frame for frame in frames if frame is not None and len(frame)]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=names, dtype=object)
+        df = _type_unloaded(df, description)
+        logging.info("Parsed %s rows in %.1fs" % (len(df), time.time() - start))
+        metrics.emit("unload_to_dataframe", rows=len(df), parts=len(filenames), download=download, parse=time.time() - start)
+    finally:
+        downloader.close()
+        shutil.rmtree(target_dir, ignore_errors=True)
+        try:
+            scratch_keys = [keyname for keyname, _ in downloader.list_keys(scratch)]
+            if scratch_keys:
+                S3Uploader(s3conf, bucketname).delete(scratch_keys)
+        except Exception as exc:
+            logging.warning("failed to remove unload scratch keys under %s" % scratch)
+            logging.warning(exc)
+
+    return df
+
+
+def _run_delete(conn, table, where, data, params, join_threshold, not_run, create_joins=True, drop_joins=True):
+    """adds 'params' to the 'where' clauses of a DELETE on 'table' and runs it, returns rows deleted.
+    List params of at most 'join_threshold' values become IN clauses. Longer lists are bulk inserted into a temp
+    table and joined with DELETE ... USING, so the statement stays small whatever the list size.
+    create_joins=False reuses the temp tables filled by an earlier call on the same connection and
+    drop_joins=False keeps them for a later one"""
+
+    joins = []  # (param, temp table, values)
     for param in params:
         data[param + "_col"] = AsIs(param)
-        if isinstance(params[param], list):
-            where.append("%({}_col)s in (%({}_val)s)".format(param, param))
-            data[param + "_val"] = AsIs(','.join(["'{}'".format(p) for p in params[param]]))
+        values = params[param]
+        if isinstance(values, list):
+            if not values:
+                where.append("FALSE")  # nothing can match an empty list
+            elif len(values) > join_threshold and not not_run:
+                joins.append((param, "botowraps_{}_values".format(re.sub(r'\W', '_', param)), values))
+            else:
+                where.append("%({}_col)s IN %({}_val)s".format(param, param))
+                data[param + "_val"] = tuple(values)  # adapted and escaped by psycopg2
         else:
             where.append("%({}_col)s = %({}_val)s".format(param, param))
-            data[param + "_val"] = params[param]
+            data[param + "_val"] = values
 
+    sql = """DELETE FROM %(table)s"""
+    if joins:
+        sql += " USING " + ", ".join(temp_table for _, temp_table, _ in joins)
+        where += ["%(table)s.{} = {}.val".format(param, temp_table) for param, temp_table, _ in joins]
     if len(where) > 0:
         sql += " WHERE " + " AND ".join(where)
 
     cur = conn.cursor()
     if not_run:
         return cur.mogrify(sql, data)
-    else:
+
+    start = time.time()
+    try:
+        for param, temp_table, values in (joins if create_joins else []):
+            # temp column takes the type of the filtered column
+            cur.execute("""DROP TABLE IF EXISTS {0}; CREATE TEMP TABLE {0} AS SELECT %(col)s AS val FROM %(table)s WHERE FALSE""".format(temp_table),
+                        {"col": AsIs(param), "table": AsIs(table)})
+            execute_values(cur, "INSERT INTO {} (val) VALUES %s".format(temp_table), [(v,) for v in values], page_size=1000)
         cur.execute(sql, data)
+        deleted = cur.rowcount
+        for _, temp_table, _ in (joins if drop_joins else []):
+            cur.execute("DROP TABLE {}".format(temp_table))
         conn.commit()
-        return True
+        invalidate_table(table)
+    except Exception:
+        conn.rollback()
+        raise
+    logging.info("Deleted %s rows from %s" % (deleted, table))
+    metrics.emit("delete", table=table, rows=deleted, joined_params=len(joins), seconds=time.time() - start)
+    return deleted
+
+
+@_accepts_pool
+def delete(conn, table, not_run=False, params={}, join_threshold=1000):
+    """method to delete data from table. Params are 'AND'ed. List params longer than 'join_threshold' are
+    matched through a temp table join. Returns number of rows deleted"""
+
+    data = {
+        "table": AsIs(table),
+    }
+
+    return _run_delete(conn, table, [], data, params, join_threshold, not_run)
 
 
-def delete_by_date(conn, table, date_column="date", start_date=None, end_date=None, date_format="%Y-%m-%d", window=30, not_run=False, params={}):
-    """method to delete old entries from redshift by date, dates are inclusive, default span is 31 days ago to 1 day ago"""
+@_accepts_pool
+def delete_by_date(conn, table, date_column="date", start_date=None, end_date=None, date_format="%Y-%m-%d", window=30, not_run=False, params={}, join_threshold=1000,
+                   slice_days=None, progress=None, vacuum=None):
+    """method to delete old entries from redshift by date, dates are inclusive, default span is 31 days ago to 1 day ago.
+
+    With 'slice_days', the range is deleted in slices of that many days, oldest first, each committed on its own so
+    no single transaction holds locks for the whole range. 'progress' is called after each slice as
+    progress(slice_start, slice_end, rows_deleted, total_deleted). 'vacuum' runs VACUUM DELETE ONLY and ANALYZE on
+    'table' once rows were deleted, it defaults to True in sliced mode. Every slice but the last matches
+    slice_start <= date_column < next slice_start, so rows later in the day on a timestamp column are not skipped.
+    The last slice keeps the inclusive 'end_date'. List params longer than 'join_threshold' are
+    loaded into their temp tables once and joined by every slice. Returns number of rows deleted"""
 
     if end_date is None:
         end_date = (datetime.now() - timedelta(days=1)).strftime(date_format)
@@ -257,75 +764,219 @@ def delete_by_date(conn, table, date_column="date", start_date=None, end_date=No
     if start_date is None:
         start_date = (datetime.strptime(end_date, date_format) - timedelta(days=window)).strftime(date_format)
 
-    data = {
-        "table": AsIs(table),
-        "date_column": AsIs(date_column),
-        "start_date": start_date,
-        "end_date": end_date,
-    }
-
-    sql = """DELETE FROM %(table)s WHERE """
-    where = ["%(date_column)s BETWEEN %(start_date)s AND %(end_date)s"]
-
-    for param in params:
-        data[param + "_col"] = AsIs(param)
-        if isinstance(params[param], list):
-            where.append("%({}_col)s in (%({}_val)s)".format(param, param))
-            data[param + "_val"] = AsIs(','.join(["'{}'".format(p) for p in params[param]]))
+    slices = [(start_date, end_date, None)]  # (start, end, start of the next slice or None for the last)
+    if slice_days is not None:
+        if slice_days < 1:
+            raise ValueError("slice_days must be >= 1")
+        slices = []
+        slice_start, last = datetime.strptime(start_date, date_format), datetime.strptime(end_date, date_format)
+        while slice_start <= last:
+            slice_end = min(slice_start + timedelta(days=slice_days - 1), last)
+            next_start = slice_end + timedelta(days=1)
+            slices.append((slice_start.strftime(date_format), slice_end.strftime(date_format),
+                           next_start.strftime(date_format) if next_start <= last else None))
+            slice_start = next_start
+
+    statements, total = [], 0
+    for i, (slice_start, slice_end, next_start) in enumerate(slices):
+        data = {
+            "table": AsIs(table),
+            "date_column": AsIs(date_column),
+            "start_date": slice_start,
+            "end_date": slice_end,
+        }
+        if next_start is None:
+            where = ["%(date_column)s BETWEEN %(start_date)s AND %(end_date)s"]
         else:
-            where.append("%({}_col)s = %({}_val)s".format(param, param))
-            data[param + "_val"] = params[param]
+            where = ["%(date_column)s >= %(start_date)s AND %(date_column)s < %(next_start)s"]
+            data["next_start"] = next_start
+        # temp tables are per session and outlive each slice's commit. One left by a failed slice is replaced
+        # by the next delete's DROP TABLE IF EXISTS, or goes with the session
+        deleted = _run_delete(conn, table, where, data, params, join_threshold, not_run,
+                              create_joins=i == 0, drop_joins=i == len(slices) - 1)
+        if not_run:
+            statements.append(deleted)
+            continue
+        total += deleted
+        if progress is not None:
+            progress(slice_start, slice_end, deleted, total)
 
-    sql += " AND ".join(where)
-
-    cur = conn.cursor()
     if not_run:
-        return cur.mogrify(sql, data)
-    else:
-        cur.execute(sql, data)
-        conn.commit()
-        return True
+        return statements if slice_days is not None else statements[0]
+
+    if vacuum is None:
+        vacuum = slice_days is not None
+    if vacuum and total > 0:
+        _run_maintenance(conn, ["VACUUM DELETE ONLY %s" % table, "ANALYZE %s" % table])
+    return total
+
 
+@_accepts_pool
+def upsert(conn, s3conf, bucketname, keyname, table, unique_key="id", delimiter="\t", quote_char="\"", na_string="NA", compression=None, order_by=None, manifest=False, **copy_args):
+    """merges data from S3 into 'table': rows of 'table' matching a staged row on 'unique_key' are replaced.
 
-def upsert(conn, s3conf, bucketname, keyname, table, unique_key="id", delimiter="\t", quote_char="\"", na_string="NA", compression=None):
+    'keyname' is one key, a list of keys (staged with one COPY through a manifest), or a manifest key with
+    manifest=True. 'unique_key' is a column name or a list of columns for a composite key. With 'order_by',
+    staged rows are deduplicated per key, keeping the row with the highest 'order_by' value.
+    The staging temp table is created once per session and reused. Staging load, delete and insert run in one
+    transaction that commits once. Returns (rows deleted, rows inserted)"""
 
-    update_table = table + "_updates"
+    keys = [unique_key] if isinstance(unique_key, str) else list(unique_key)
+    tablename = table.rpartition(".")[2]
+    update_table = table.replace(".", "_") + "_updates"  # temp tables cannot be schema-qualified
 
-    # create temp table in Redshift
     data = {
         "table": AsIs(table),
-        "update_table": AsIs(update_table),
-        "unique_key": AsIs(unique_key)}
+        "update_table": AsIs(update_table)}
 
-    sql = """DROP TABLE IF EXISTS %(update_table)s; CREATE TEMP TABLE %(update_table)s (LIKE %(table)s);"""
+    manifest_keyname = None
+    if isinstance(keyname, (list, tuple)):
+        # next to the first source key, with no leading slash for keys at the bucket root
+        manifest_keyname = "%s_upsert_%s.manifest" % (tablename, uuid.uuid4().hex)
+        if os.path.dirname(keyname[0]):
+            manifest_keyname = os.path.dirname(keyname[0]) + "/" + manifest_keyname
+        uploader = S3Uploader(s3conf, bucketname)
+        uploader.upload_manifest(keyname, manifest_keyname)
+        keyname, manifest = manifest_keyname, True
+
+    where = " AND ".join("%(table)s.{0} = %(update_table)s.{0}".format(key) for key in keys)
+    insert_sql = """INSERT INTO %(table)s (SELECT * FROM %(update_table)s)"""
 
     cur = conn.cursor()
-    cur.execute(sql, data)
+    start = time.time()
+    try:
+        # DELETE instead of TRUNCATE, which would commit on Redshift
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS %(update_table)s (LIKE %(table)s); DELETE FROM %(update_table)s;""", data)
+
+        if order_by is not None:
+            # column list excludes the row number used for deduplication. It comes from the staging table itself,
+            # pg_table_def only lists tables in schemas on the search_path
+            cur.execute("""SELECT * FROM %(update_table)s LIMIT 0""", data)
+            columns = ", ".join('"%s"' % desc[0].replace('"', '""') for desc in cur.description)
+            insert_sql = """INSERT INTO %(table)s (SELECT {columns} FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {order_by} DESC) AS botowraps_rn FROM %(update_table)s
+                ) ranked WHERE botowraps_rn = 1)""".format(columns=columns, keys=", ".join(keys), order_by=order_by)
+
+        # insert data into temp table, inside the merge transaction
+        copy_from_s3(conn=conn, s3conf=s3conf, bucketname=bucketname, keyname=keyname, table=update_table, delimiter=delimiter, quote_char=quote_char,
+                     na_string=na_string, compression=compression, manifest=manifest, commit=False, **copy_args)
+
+        cur.execute("""DELETE FROM %(table)s USING %(update_table)s WHERE """ + where, data)
+        deleted = cur.rowcount
+        cur.execute(insert_sql, data)
+        inserted = cur.rowcount
+        conn.commit()
+        invalidate_table(table)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if manifest_keyname is not None:
+            uploader.delete([manifest_keyname])
 
-    # insert data into new temp table
-    copy_from_s3(conn=conn, s3conf=s3conf, bucketname=bucketname, keyname=keyname, table=update_table, delimiter=delimiter, quote_char=quote_char, na_string=na_string, compression=compression)
-
-    # upsert data from temp table into original table, drop temp table
-    sql = """
-    begin transaction;
-    DELETE FROM %(table)s
-    USING %(update_table)s
-    WHERE %(table)s.%(unique_key)s = %(update_table)s.%(unique_key)s;
-
-    INSERT INTO %(table)s (
-        SELECT * FROM %(update_table)s
-        );
-    end transaction;
-    DROP TABLE %(update_table)s;
-    """
+    logging.info("Upserted %s: %s rows deleted, %s rows inserted" % (table, deleted, inserted))
+    metrics.emit("upsert", table=table, deleted=deleted, inserted=inserted, seconds=time.time() - start)
+    return deleted, inserted
+
+
+def _run_maintenance(conn, statements):
+    """runs each statement outside of a transaction block, returns seconds spent per statement"""
+    iso_lvl = conn.isolation_level
+    conn.set_isolation_level(0)  # isolation to 0 allows queries like vacuum which do not occur within a transaction block
+    timings = []
+    try:
+        rcur = conn.cursor()
+        for statement in statements:
+            start = time.time()
+            rcur.execute(statement)
+            timings.append(time.time() - start)
+            logging.info("%s took %.1fs" % (statement, timings[-1]))
+            metrics.emit("maintenance", statement=statement, seconds=timings[-1])
+    finally:
+        conn.set_isolation_level(iso_lvl)  # reset to original setting
+    return timings
+
+
+@_accepts_pool
+def plan_maintenance(conn, unsorted_threshold=10, deleted_threshold=10, stats_off_threshold=10, min_rows=0, schema=None):
+    """reads svv_table_info and lists the tables that need maintenance, most beneficial first.
+
+    A table gets VACUUM SORT ONLY above 'unsorted_threshold' percent unsorted rows, VACUUM DELETE ONLY above
+    'deleted_threshold' percent deleted rows, VACUUM FULL above both, and ANALYZE PREDICATE COLUMNS above
+    'stats_off_threshold' percent stale statistics. The benefit of a table is the estimated number of rows
+    its vacuum rewrites plus those whose statistics are stale.
+    Returns a list of dicts with 'table', 'vacuum' (variant or None), 'analyze', the svv_table_info figures and 'benefit'"""
+
+    sql = """SELECT "schema", "table", COALESCE(unsorted, 0), COALESCE(stats_off, 0), COALESCE(tbl_rows, 0), COALESCE(estimated_visible_rows, 0)
+        FROM svv_table_info WHERE COALESCE(tbl_rows, 0) >= %(min_rows)s"""
+    data = {"min_rows": min_rows}
+    if schema is not None:
+        sql += """ AND "schema" = %(schema)s"""
+        data["schema"] = schema
+
+    cur = conn.cursor()
     cur.execute(sql, data)
 
+    plan = []
+    for table_schema, table, unsorted, stats_off, tbl_rows, visible_rows in cur.fetchall():
+        unsorted, stats_off, tbl_rows = float(unsorted), float(stats_off), int(tbl_rows)
+        deleted = 100.0 * max(tbl_rows - int(visible_rows), 0) / tbl_rows if tbl_rows else 0.0
+
+        sort, purge = unsorted > unsorted_threshold, deleted > deleted_threshold
+        vacuum = "FULL" if sort and purge else "SORT ONLY" if sort else "DELETE ONLY" if purge else None
+        analyze = stats_off > stats_off_threshold
+        if vacuum is None and not analyze:
+            continue
+
+        benefit = tbl_rows * ((unsorted if sort else 0) + (deleted if purge else 0) + (stats_off if analyze else 0)) / 100
+        plan.append({"table": "%s.%s" % (table_schema, table), "vacuum": vacuum, "analyze": analyze, "unsorted": unsorted,
+                     "deleted": deleted, "stats_off": stats_off, "tbl_rows": tbl_rows, "benefit": benefit})
+
+    plan.sort(key=lambda entry: entry["benefit"], reverse=True)
+    return plan
+
+
+@_accepts_pool
+def run_maintenance(conn, plan=None, time_budget=3600, **thresholds):
+    """runs the vacuum/analyze statements of 'plan' (from plan_maintenance, built with 'thresholds' if not given)
+    in order, within 'time_budget' seconds. After the first vacuum, tables whose vacuum is expected to
+    overrun the remaining budget, going by the rows per second achieved so far, are skipped.
+    Returns a list of (table, statements, seconds) for the tables maintained"""
+
+    if plan is None:
+        plan = plan_maintenance(conn, **thresholds)
+
+    start = time.time()
+    done, rows_done, vacuum_seconds = [], 0, 0.0
+    for i, entry in enumerate(plan):
+        remaining = time_budget - (time.time() - start)
+        if remaining <= 0:
+            logging.info("Maintenance budget spent, %s tables left" % (len(plan) - i))
+            break
+
+        statements = []
+        if entry["vacuum"] is not None:
+            if rows_done and vacuum_seconds and entry["tbl_rows"] / (rows_done / vacuum_seconds) > remaining:
+                logging.info("Skipping vacuum of %s, not expected to finish within budget" % entry["table"])
+            else:
+                statements.append("VACUUM %s %s" % (entry["vacuum"], entry["table"]))
+        if entry["analyze"] or statements:
+            statements.append("ANALYZE %s PREDICATE COLUMNS" % entry["table"])
+        if not statements:
+            continue  # vacuum skipped and no analyze needed
+
+        timings = _run_maintenance(conn, statements)
+        if entry["vacuum"] is not None and len(timings) == 2:
+            rows_done += entry["tbl_rows"]
+            vacuum_seconds += timings[0]
+        done.append((entry["table"], statements, sum(timings)))
+        logging.info("Maintenance of %s took %.1fs" % (entry["table"], done[-1][2]))
+
+    return done
 
+
+@_accepts_pool
 def vacuum_analyze(conn):
+    """vacuums and analyzes every table of the database, see run_maintenance for a targeted alternative"""
     logging.info("Running Vacuum/Analyze on Redshift")
-    iso_lvl = conn.isolation_level
-    conn.set_isolation_level(0)  # isolation to 0 allows queries like vacuum which do not occur within a transaction block
-    rcur = conn.cursor()
-    rcur.execute("vacuum;analyze;")
-    conn.commit()
-    conn.set_isolation_level(iso_lvl)  # reset to original setting
+    _run_maintenance(conn, ["vacuum;analyze;"])
@@ -4,18 +4,203 @@
 import os
 import io
 import sys
+import mmap
+import zlib
 import time
 import json
+import queue
 import random
+import hashlib
 import logging
+import functools
+import threading
 import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # third party lib imports
 from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
 
+# local imports
+from botowraps import metrics
 
-class S3Uploader(object):
-    def __init__(self, s3conf, bucketname, threads=1, chunksize_mb=5, attempt_limit=5, timeout=10800):
+
+# S3 multipart limits
+MIN_PART_SIZE = 5 * 2**20
+MAX_PART_SIZE = 5 * 2**30
+MAX_PARTS = 10000
+
+
+# uploader copy held by each multiprocessing worker for the lifetime of the process
+_worker_uploader = None
+
+
+def build_copy_manifest(bucketname, keys, mandatory=True):
+    """returns a Redshift COPY manifest as a dict. 'keys' are keynames or (keyname, content_length) tuples"""
+    entries = []
+    for item in keys:
+        keyname, size = item if isinstance(item, tuple) else (item, None)
+        entry = {"url": "s3://%s/%s" % (bucketname, keyname), "mandatory": mandatory}
+        if size is not None:
+            entry["meta"] = {"content_length": size}
+        entries.append(entry)
+    return {"entries": entries}
+
+
+def parse_unload_manifest(manifest):
+    """returns [(bucketname, keyname, content_length)] for the files of an UNLOAD (or COPY) manifest, given as a
+    JSON string, bytes or an already parsed dict. content_length is None unless the manifest was written VERBOSE"""
+    if isinstance(manifest, bytes):
+        manifest = manifest.decode("utf-8")
+    if isinstance(manifest, str):
+        manifest = json.loads(manifest)
+    files = []
+    for entry in manifest["entries"]:
+        bucketname, keyname = entry["url"].replace("s3://", "", 1).split("/", 1)
+        files.append((bucketname, keyname, entry.get("meta", {}).get("content_length")))
+    return files
+
+
+def _init_worker(uploader):
+    global _worker_uploader
+    # forked workers inherit the parent's thread-local state, never reuse the parent's sockets
+    uploader._local = threading.local()
+    _worker_uploader = uploader
+
+
+def _upload_part_worker(item):
+    # events of the part are returned with its result and emitted again in the parent, where listeners live
+    chunk, submitted = item
+    with metrics.capture() as events:
+        result = _worker_uploader._upload_part(chunk, submitted)
+    return result, events
+
+
+def _multipart_etag(filename, chunksize):
+    """ETag S3 gives 'filename' when uploaded by S3Uploader with part size 'chunksize': the MD5 of a single PUT below
+    the multipart threshold, else the MD5 of the concatenated part MD5s followed by -<number of parts>"""
+    fsize = os.stat(filename).st_size
+    if fsize == 0:
+        return hashlib.md5(b"").hexdigest()
+    with open(filename, "rb") as ff, mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            if fsize < MIN_PART_SIZE:
+                return hashlib.md5(view).hexdigest()
+            digests = [hashlib.md5(view[start:start + chunksize]).digest() for start in range(0, fsize, chunksize)]
+        finally:
+            view.release()
+    return "%s-%d" % (hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+
+
+@contextmanager
+def _file_view(filename, sbyte, nbytes):
+    # serve a chunk as a slice of the memory-mapped file rather than reading it into a buffer
+    with open(filename, 'rb') as ff, mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)[sbyte:sbyte + nbytes]
+        try:
+            yield view
+        finally:
+            view.release()
+
+
+@contextmanager
+def _buffer_view(buf, nbytes):
+    view = memoryview(buf)[:nbytes]
+    try:
+        yield view
+    finally:
+        view.release()
+
+
+class _StreamFiller(object):
+    """fills fixed-size buffers from a file object (readinto or read) or an iterable of bytes/str chunks"""
+
+    def __init__(self, source):
+        self._readinto = getattr(source, "readinto", None)
+        self._read = getattr(source, "read", None)
+        self._chunks = iter(source) if self._readinto is None and self._read is None else None
+        self._pending = b""  # part of the last iterable chunk that did not fit in the previous buffer
+
+    def _next_chunk(self, size):
+        if self._read is not None:
+            data = self._read(size)
+            return data.encode("utf-8") if isinstance(data, str) else data  # text mode files
+        for data in self._chunks:
+            if data:
+                return data.encode("utf-8") if isinstance(data, str) else data
+        return b""
+
+    def fill(self, buf):
+        """fills 'buf' from the source, returns the number of bytes written, less than len(buf) only at the end"""
+        view = memoryview(buf)
+        filled = 0
+        try:
+            while filled < len(view):
+                if self._readinto is not None:
+                    n = self._readinto(view[filled:])
+                    if not n:
+                        break
+                    filled += n
+                    continue
+
+                if not self._pending:
+                    self._pending = self._next_chunk(len(view) - filled)
+                    if not self._pending:
+                        break
+                n = min(len(self._pending), len(view) - filled)
+                view[filled:filled + n] = self._pending[:n]
+                self._pending = self._pending[n:]
+                filled += n
+        finally:
+            view.release()
+        return filled
+
+
+class _MemoryViewReader(io.RawIOBase):
+    """read-only file object over a memoryview. Reads are served as small slices of the view, so a part is never copied whole"""
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._view) - self._pos
+        data = self._view[self._pos:self._pos + size].tobytes()
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class _S3Client(object):
+    """connection handling shared by S3Uploader and S3Downloader"""
+
+    def __init__(self, s3conf, bucketname, backoff_base=0.5, backoff_cap=20):
         self.s3conf = s3conf  # expects s3conf as `dict` with keys "aws_access_key_id" and "aws_secret_access_key" defined
         if isinstance(s3conf, str):
             with open(s3conf) as fi:
@@ -23,13 +208,10 @@ class S3Uploader(object):
         elif isinstance(s3conf, dict):
             self.s3conf = s3conf
 
+        self._local = threading.local()  # per-thread cached connection and bucket
         self._check_bucket(bucketname)  # s3 bucket  name
-        self.chunksize = int(chunksize_mb * 2**20)  # get chunksize in bytes
-        self.attempt_limit = attempt_limit  # default 5 attempts per chunk
-        self.timeout = timeout  # default 3 hours (10800 seconds)
-        if threads <= 0:  # number of threads
-            raise ValueError("threads must be > 0")
-        self.threads = threads  # number of parallel threads for upload
+        self.backoff_base = backoff_base  # seconds, retries wait up to backoff_base * 2^(attempt - 1), with full jitter
+        self.backoff_cap = backoff_cap  # upper limit of a single retry wait in seconds
 
     def _get_bucket(self, validate=False):
         conn = S3Connection(**self.s3conf)
@@ -40,57 +222,379 @@ class S3Uploader(object):
         self.bucketname = bucketname
         bucket = self._get_bucket(validate=True)
 
+    def _worker_bucket(self):
+        """returns the bucket bound to this thread's S3Connection, opened once and reused for the thread's lifetime"""
+        bucket = getattr(self._local, "bucket", None)
+        if bucket is None:
+            bucket = self._local.bucket = self._get_bucket()
+        return bucket
+
+    def _reset_worker_bucket(self):
+        # drop a connection that may be in a bad state, the next call reconnects
+        self._local.bucket = None
+
+    def _backoff(self, attempts):
+        # exponential backoff with full jitter, called only after a failed attempt
+        time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempts - 1))))
+
+
+class S3Uploader(_S3Client):
+    def __init__(self, s3conf, bucketname, threads=1, chunksize_mb=5, attempt_limit=5, timeout=10800, executor="process", checkpoint_dir=None,
+                 backoff_base=0.5, backoff_cap=20, target_part_seconds=4):
+        super(S3Uploader, self).__init__(s3conf, bucketname, backoff_base, backoff_cap)
+        # chunksize_mb="auto" sizes parts per file from the file size and the throughput measured on earlier parts
+        self.auto_chunksize = chunksize_mb == "auto"
+        self.chunksize = 8 * 2**20 if self.auto_chunksize else int(chunksize_mb * 2**20)  # get chunksize in bytes
+        self.target_part_seconds = target_part_seconds  # with auto chunksize, aim for parts taking this long to send
+        self._throughput = None  # moving average of bytes/second achieved by one worker sending one part
+        self.attempt_limit = attempt_limit  # default 5 attempts per chunk
+        self.timeout = timeout  # default 3 hours (10800 seconds)
+        if threads <= 0:  # number of threads
+            raise ValueError("threads must be > 0")
+        self.threads = threads  # number of parallel threads for upload
+        if executor not in ("process", "thread"):
+            raise ValueError("executor must be one of: [process, thread]")
+        self.executor = executor  # run parts on a multiprocessing.Pool or a thread pool when threads > 1
+        self.checkpoint_dir = checkpoint_dir  # if set, failed multipart uploads are kept and resumed from checkpoint files
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._pool = None  # worker pool, created on first use and kept across upload calls
+        self._thread_pool = None  # thread pool for upload_many when executor="process"
+
+    def __getstate__(self):
+        # connections and pools are not shared between processes, each worker opens its own
+        state = self.__dict__.copy()
+        for attr in ("_local", "_pool_lock", "_stats_lock", "_pool", "_thread_pool"):
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._pool = None
+        self._thread_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """shuts down the worker pools, if any were started"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+            thread_pool, self._thread_pool = self._thread_pool, None
+        if thread_pool is not None:
+            thread_pool.shutdown(wait=True)
+        if pool is None:
+            return
+        if self.executor == "thread":
+            pool.shutdown(wait=True)
+        else:
+            pool.close()
+            pool.join()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                if self.executor == "thread":
+                    self._pool = ThreadPoolExecutor(max_workers=self.threads)
+                else:
+                    # each process keeps its own copy of the uploader and one S3 connection
+                    self._pool = multiprocessing.Pool(self.threads, initializer=_init_worker, initargs=(self,))
+            return self._pool
+
+    def _get_thread_pool(self):
+        # thread pool regardless of executor, for work scheduled from the calling process
+        if self.executor == "thread":
+            return self._get_pool()
+        with self._pool_lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(max_workers=self.threads)
+            return self._thread_pool
+
+    def _terminate_pool(self):
+        # process workers cannot be cancelled mid-task, drop the pool so abandoned parts stop using it
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+
+    def _get_multipart(self, bucket, keyname, mp_id):
+        """addresses an in-progress multipart upload directly by key and upload id, without listing uploads"""
+        mp = MultiPartUpload(bucket)
+        mp.key_name = keyname
+        mp.id = mp_id
+        return mp
+
     def kill_old_multipart_uploads(self):
-        bucket = self._get_bucket()
+        bucket = self._worker_bucket()
         for mp in bucket.get_all_multipart_uploads():
             mp.cancel_upload()
 
+    def abort_stale_multipart_uploads(self, max_age_hours=24, prefix=None):
+        """cancels only multipart uploads initiated more than 'max_age_hours' ago, optionally limited to keys
+        starting with 'prefix'. Returns the list of (keyname, upload id) cancelled"""
+        cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
+        cancelled = []
+        for mp in self._worker_bucket().list_multipart_uploads():
+            if prefix is not None and not mp.key_name.startswith(prefix):
+                continue
+            if datetime.strptime(mp.initiated, "%Y-%m-%dT%H:%M:%S.%fZ") < cutoff:
+                logging.info("Cancelling stale multipart upload %s of %s, initiated %s" % (mp.id, mp.key_name, mp.initiated))
+                mp.cancel_upload()
+                cancelled.append((mp.key_name, mp.id))
+        return cancelled
+
     def delete(self, keynames):
-        bucket = self._get_bucket()
+        bucket = self._worker_bucket()
         logging.info("Deleting keys: %s" % keynames)
         return bucket.delete_keys(keynames)
 
-    def _file_chunker(self, mp_id, filename):
+    def upload_manifest(self, keys, manifest_keyname, mandatory=True):
+        """writes a COPY manifest listing 'keys' (keynames or (keyname, content_length) tuples) to 'manifest_keyname'.
+        Sizes of keys given by name are looked up with one listing of their common prefix. Returns manifest_keyname"""
+        keys = list(keys)
+        unsized = [k for k in keys if not isinstance(k, tuple)]
+        if unsized:
+            prefix = os.path.commonprefix(unsized)
+            sizes = dict((key.name, key.size) for key in self._worker_bucket().list(prefix=prefix))
+            missing = [k for k in unsized if k not in sizes]
+            if missing:
+                raise ValueError("keys not found in bucket %s: %s" % (self.bucketname, missing))
+            keys = [k if isinstance(k, tuple) else (k, sizes[k]) for k in keys]
+
+        manifest = build_copy_manifest(self.bucketname, keys, mandatory=mandatory)
+        self._worker_bucket().new_key(manifest_keyname).set_contents_from_string(json.dumps(manifest))
+        logging.info("Wrote manifest of %s keys to %s" % (len(keys), manifest_keyname))
+        return manifest_keyname
+
+    def _chunksize_for(self, fsize, adaptive=True):
+        """part size for a file of 'fsize' bytes, in whole MB and within S3's part size and part count limits.
+        With adaptive=False measured throughput is ignored, so the size only depends on fsize"""
+        chunksize = self.chunksize
+        if self.auto_chunksize:
+            with self._stats_lock:
+                throughput = self._throughput
+            if throughput is not None and adaptive:
+                chunksize = throughput * self.target_part_seconds  # fewer requests when the link is fast
+            chunksize = min(chunksize, -(-fsize // self.threads))  # but at least one part per worker
+            chunksize = max(chunksize, MIN_PART_SIZE)
+
+        chunksize = max(chunksize, -(-fsize // MAX_PARTS))
+        chunksize = -(-int(chunksize) // 2**20) * 2**20  # round up to whole MB
+        return min(chunksize, MAX_PART_SIZE)
+
+    def _record_throughput(self, nbytes, elapsed):
+        if elapsed <= 0:
+            return
+        with self._stats_lock:
+            rate = nbytes / elapsed
+            self._throughput = rate if self._throughput is None else 0.8 * self._throughput + 0.2 * rate
+
+    def _file_chunker(self, mp_id, filename, keyname, chunksize=None):
         """generator that returns tuples consumed by _upload_part worker function during multipart upload"""
         fsize = os.stat(filename).st_size  # filesize, used to calculate chunk size
+        chunksize = self._chunksize_for(fsize) if chunksize is None else chunksize
         sbyte = 0  # starting byte to read in file
         chunk_num = 1  # ordinal for chunks, indexed to 1
 
         while sbyte < fsize:  # while the starting byte is less than the total number of bytes
-            nbytes = min([self.chunksize, fsize - sbyte])  # number of bytes in chunk
-            yield (mp_id, self.bucketname, filename, self.attempt_limit, chunk_num, sbyte, nbytes)
+            nbytes = min([chunksize, fsize - sbyte])  # number of bytes in chunk
+            yield (mp_id, keyname, filename, self.attempt_limit, chunk_num, sbyte, nbytes)
             chunk_num += 1
             sbyte += nbytes  # move starting byte to next position
 
-    def _upload_part(self, args):
+    def _upload_part(self, args, submitted=None):
         """Multipart Upload multiprocessing worker function, reads chunk from file and sends to S3"""
         # unpack arguments
-        (mp_id, bucketname, filename, attempt_limit, chunk_num, sbyte, nbytes) = args
+        (mp_id, keyname, filename, attempt_limit, chunk_num, sbyte, nbytes) = args
+        return self._send_part(mp_id, keyname, os.path.basename(filename), attempt_limit, chunk_num, nbytes,
+                               lambda: _file_view(filename, sbyte, nbytes), submitted)
+
+    def _send_part(self, mp_id, keyname, label, attempt_limit, chunk_num, nbytes, open_view, submitted=None):
+        """sends one part, retrying up to 'attempt_limit' times. 'open_view' returns a context manager yielding
+        the part's bytes as a memoryview. 'submitted' is the time the part was handed to a pool, for the queued
+        time of its 'part' metrics event. Returns (chunk_num, success, etag, nbytes, elapsed)"""
         attempts = 0
         success = False
+        etag = None
+        elapsed = 0
+        start = time.time()
         while attempts < attempt_limit and not success:  # keep trying upload until success or limit reached
+            if attempts > 0:
+                self._backoff(attempts)
             attempts += 1
-            time.sleep(random.uniform(0.01, 0.49))  # be nice to your APIs, make request on average after .25 second wait
-            logging.info("%s Uploading chunk %s. Attempt #%s" % (os.path.basename(filename), chunk_num, attempts))
+            attempt_start = time.time()
+            logging.info("%s Uploading chunk %s. Attempt #%s" % (label, chunk_num, attempts))
             try:
-                with open(filename, 'rb') as ff:
-                    ff.seek(sbyte)  # go to starting byte
-                    bb = ff.read(nbytes)  # read chunk
-                    fp = io.BytesIO(bb)  # write bytes to fp
-                    fp.seek(0)  # set head to start of fp object
-
-                bucket = self._get_bucket()
-                for mp in bucket.get_all_multipart_uploads():
-                    if mp.id == mp_id:  # make sure chunk goes to correct key in S3
-                        mp.upload_part_from_file(fp=fp, part_num=chunk_num)
-
-                logging.info("%s Chunk %s successfully uploaded. %s Attempts." % (os.path.basename(filename), chunk_num, attempts))
+                with open_view() as view:
+                    mp = self._get_multipart(self._worker_bucket(), keyname, mp_id)
+                    etag = mp.upload_part_from_file(fp=_MemoryViewReader(view), part_num=chunk_num).etag
+
+                elapsed = time.time() - attempt_start
+                logging.info("%s Chunk %s successfully uploaded. %s Attempts." % (label, chunk_num, attempts))
                 success = True  # break loop on success
             except Exception as exc:
                 # fail gracefully so exception does not disrupt retry
-                logging.info("%s Chunk %s upload failed on attempt #%s." % (os.path.basename(filename), chunk_num, attempts))
+                logging.info("%s Chunk %s upload failed on attempt #%s." % (label, chunk_num, attempts))
                 logging.warn(exc)
-        return (chunk_num, success)
+                self._reset_worker_bucket()
+        metrics.emit("part", keyname=keyname, part=chunk_num, bytes=nbytes, success=success, retries=attempts - 1,
+                     latency=elapsed, in_flight=time.time() - start, queued=start - (submitted or start))
+        return (chunk_num, success, etag, nbytes, elapsed)
+
+    def _run_parts(self, fchunks, deadline):
+        """generator that uploads chunks and yields (chunk_num, success, etag, nbytes, elapsed) as parts finish, raises TimeoutError after 'deadline'"""
+        if self.threads == 1:
+            # does not use any worker pool
+            for chunk in fchunks:
+                yield self._upload_part(chunk, time.time())
+                if time.time() > deadline:
+                    raise TimeoutError("upload exceeded timeout of %s seconds" % self.timeout)
+
+        elif self.executor == "thread":
+            # thread pool persists across uploads and is safe to share between application threads.
+            # chunks are submitted as workers free up, so at most 2 x threads parts are outstanding
+            executor = self._get_pool()
+            pending = set()
+            try:
+                for chunk in fchunks:
+                    pending.add(executor.submit(self._upload_part, chunk, time.time()))
+                    while len(pending) >= self.threads * 2:
+                        done, pending = self._wait_parts(pending, deadline)
+                        for future in done:
+                            yield future.result()
+                while pending:
+                    done, pending = self._wait_parts(pending, deadline)
+                    for future in done:
+                        yield future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        else:
+            # spawns multiprocessing worker processes once, reused by later uploads
+            # chunks are stamped as the pool's feeder thread takes them, so queued time covers the pool's task queue
+            parts = self._get_pool().imap_unordered(_upload_part_worker, ((chunk, time.time()) for chunk in fchunks))
+            finished = False
+            try:
+                while True:
+                    try:
+                        part_result, events = parts.next(timeout=max(0, deadline - time.time()))
+                    except StopIteration:
+                        break
+                    except multiprocessing.TimeoutError:
+                        raise TimeoutError("upload exceeded timeout of %s seconds" % self.timeout)
+                    for name, fields in events:
+                        metrics.emit(name, **fields)
+                    yield part_result
+                finished = True
+            finally:
+                if not finished:
+                    self._terminate_pool()
+
+    def _wait_parts(self, pending, deadline):
+        done, pending = wait(pending, timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError("upload exceeded timeout of %s seconds" % self.timeout)
+        return done, pending
+
+    def _abandon_multipart(self, mp, keyname):
+        # with checkpoints the parts already sent are kept for the next attempt, otherwise they are discarded
+        if self.checkpoint_dir is not None:
+            logging.warning("%s Multipart Upload %s kept, call upload again to resume from checkpoint." % (keyname, mp.id))
+        else:
+            logging.warning("Cancelling Multipart Upload of %s." % keyname)
+            mp.cancel_upload()
+        return None
+
+    def _simple_upload(self, filename, keyname):
+        logging.info("%s too small for multipart, reverting to simple upload" % keyname)
+        start = time.time()
+        key = self._worker_bucket().new_key(keyname)
+        key.set_contents_from_filename(filename)
+        logging.info("%s Upload Complete!" % keyname)
+        metrics.emit("put", keyname=keyname, bytes=key.size, latency=time.time() - start)
+
+    def _complete_multipart(self, mp, keyname, num_parts, cancel=True):
+        """completes a multipart upload, returns False if S3 is missing parts or completion fails.
+        The upload is cancelled on failure unless 'cancel' is False"""
+        # ensure S3 has collected all parts of upload, compare to number of chunks uploaded.
+        # iterating pages through ListParts, which returns at most 1000 parts per request
+        if sum(1 for _ in mp) == num_parts:
+            try:
+                mp.complete_upload()
+                logging.info("%s Upload Complete!" % keyname)
+                return True
+            except Exception as exc:
+                logging.warning("%s failed to upload compltely." % keyname)
+                logging.warning(exc)
+        else:
+            logging.warning("%s failed to upload completely." % keyname)
+        if cancel:
+            logging.warning("Cancelling Multipart Upload of %s." % keyname)
+            mp.cancel_upload()
+        return False
+
+    def _checkpoint_path(self, keyname):
+        digest = hashlib.sha1(("%s/%s" % (self.bucketname, keyname)).encode("utf-8")).hexdigest()
+        return os.path.join(self.checkpoint_dir, digest + ".json")
+
+    def _load_checkpoint(self, keyname, filename, fstat):
+        """returns the (multipart upload, chunksize, {part number: etag}) recorded for a previous attempt at
+        uploading this file, with only the parts S3 still holds with a matching ETag, or None"""
+        path = self._checkpoint_path(keyname)
+        if not os.path.exists(path):
+            return None
+
+        # checkpoint is a JSON header line followed by one JSON line per finished part
+        parts = {}
+        with open(path) as fi:
+            lines = fi.read().splitlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return None
+        for line in lines[1:]:
+            try:
+                part = json.loads(line)
+            except ValueError:  # last line may be cut short by a crash
+                continue
+            parts[part["part"]] = part["etag"]
+
+        source = (os.path.abspath(filename), fstat.st_size, fstat.st_mtime)
+        if (header["filename"], header["fsize"], header["mtime"]) != source:
+            logging.info("%s changed since checkpoint was written, starting a new upload" % filename)
+            return None
+
+        mp = self._get_multipart(self._worker_bucket(), keyname, header["mp_id"])
+        try:
+            remote = dict((part.part_number, part.etag) for part in mp)
+        except Exception as exc:
+            logging.info("Multipart upload %s of %s is no longer available, starting a new upload" % (header["mp_id"], keyname))
+            logging.info(exc)
+            return None
+        done = dict((num, etag) for num, etag in parts.items() if remote.get(num) == etag)
+        logging.info("%s Resuming multipart upload %s, %s parts already uploaded" % (keyname, mp.id, len(done)))
+        return mp, header["chunksize"], done
+
+    def _start_checkpoint(self, keyname, filename, fstat, mp, chunksize, done):
+        # rewrite the checkpoint with the parts known to be done, later parts are appended as they finish
+        path = self._checkpoint_path(keyname)
+        header = {"bucket": self.bucketname, "keyname": keyname, "filename": os.path.abspath(filename),
+                  "fsize": fstat.st_size, "mtime": fstat.st_mtime, "mp_id": mp.id, "chunksize": chunksize}
+        with open(path + ".tmp", "w") as fo:
+            fo.write(json.dumps(header) + "\n")
+            for num, etag in sorted(done.items()):
+                fo.write(json.dumps({"part": num, "etag": etag}) + "\n")
+        os.replace(path + ".tmp", path)
+        return open(path, "a")
 
     def upload(self, filename, keyname=None):
         """sends file to S3 with optimal method, returns False on failure, True on success"""
@@ -99,77 +603,574 @@ class S3Uploader(object):
         if keyname is None:
             keyname = os.path.basename(filename)  # shorten keyname
 
-        bucket = self._get_bucket()
-
         fsize = os.stat(filename).st_size
-        if fsize < 5242880:
+        if fsize < MIN_PART_SIZE:
             # if file less than 5mb in size, revert to simple single-part upload
-            logging.info("%s too small for multipart, reverting to simple upload" % keyname)
-            key = bucket.new_key(keyname)
-            key.set_contents_from_filename(filename)
-            logging.info("%s Upload Complete!" % keyname)
+            self._simple_upload(filename, keyname)
 
+        elif self._multipart_upload(filename, keyname) is None:
+            return None
+
+        end_time = time.time()
+        upload_speed_mbps = (fsize / 2**20) / (end_time - start_time)
+
+        logging.info("Upload Speed: %f MB/s" % (upload_speed_mbps))
+        metrics.emit("upload", keyname=keyname, bytes=fsize, seconds=end_time - start_time, mbps=upload_speed_mbps)
+        return keyname
+
+    def _multipart_upload(self, filename, keyname):
+        """uploads a file in parts, resuming from a checkpoint if one matches. Returns keyname, or None on failure"""
+        fstat = os.stat(filename)
+        chunksize = self._chunksize_for(fstat.st_size)
+        done = {}  # part number -> etag of parts already in S3
+        checkpoint = None
+
+        resumed = self._load_checkpoint(keyname, filename, fstat) if self.checkpoint_dir is not None else None
+        if resumed is not None:
+            mp, chunksize, done = resumed
+        else:
+            mp = self._worker_bucket().initiate_multipart_upload(keyname)  # initiate multipart upload
+        if self.checkpoint_dir is not None:
+            checkpoint = self._start_checkpoint(keyname, filename, fstat, mp, chunksize, done)
+
+        # create file chunk generator, skipping parts uploaded by an earlier attempt
+        fchunks = (chunk for chunk in self._file_chunker(mp.id, filename, keyname, chunksize) if chunk[4] not in done)
+        num_parts = -(-fstat.st_size // chunksize)  # rounded up
+
+        # results are checked as parts finish, a failed part stops the upload without waiting for the rest
+        parts = self._run_parts(fchunks, time.time() + self.timeout)
+        try:
+            for chunk_num, success, etag, nbytes, elapsed in parts:
+                if not success:
+                    logging.warning("Chunk %s failed to upload." % chunk_num)
+                    parts.close()  # stop outstanding parts before cancelling
+                    return self._abandon_multipart(mp, keyname)
+                self._record_throughput(nbytes, elapsed)
+                if checkpoint is not None:
+                    checkpoint.write(json.dumps({"part": chunk_num, "etag": etag}) + "\n")
+                    checkpoint.flush()
+        except Exception as exc:
+            # e.g. timeout error
+            logging.warning("%s failed to upload." % keyname)
+            logging.warning(exc)
+            parts.close()
+            return self._abandon_multipart(mp, keyname)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+
+        if not self._complete_multipart(mp, keyname, num_parts, cancel=self.checkpoint_dir is None):
+            return None
+        if self.checkpoint_dir is not None:
+            os.unlink(self._checkpoint_path(keyname))
+        return keyname
+
+    def upload_stream(self, source, keyname, max_buffers=None):
+        """uploads data of unknown size from a readable file object or an iterable of bytes (or str) chunks,
+        without writing it to disk. Data is collected into 'chunksize' part buffers which are sent on the thread
+        pool while the producer keeps writing. At most 'max_buffers' buffers exist at once (default threads + 1),
+        which bounds memory use. Streams that end within the first buffer are sent as a single PUT.
+        Returns keyname, or None on failure"""
+        start_time = time.time()
+        chunksize = self.chunksize
+        max_buffers = self.threads + 1 if max_buffers is None else max_buffers
+        filler = _StreamFiller(source)
+        buffers = _BufferPool(chunksize, max_buffers)
+
+        buf = buffers.get()
+        try:
+            nbytes = filler.fill(buf)
+            if nbytes < chunksize:
+                # stream ended within the first part, revert to simple single-part upload
+                logging.info("%s too small for multipart, reverting to simple upload" % keyname)
+                with _buffer_view(buf, nbytes) as view:
+                    self._worker_bucket().new_key(keyname).set_contents_from_file(_MemoryViewReader(view))
+                logging.info("%s Upload Complete!" % keyname)
+                return keyname
+        except Exception as exc:
+            logging.warning("%s failed to upload." % keyname)
+            logging.warning(exc)
+            return None
+
+        pool = self._get_thread_pool()
+        mp = self._worker_bucket().initiate_multipart_upload(keyname)
+        deadline = time.time() + self.timeout
+        futures = []
+        failed = threading.Event()
+        chunk_num = 0
+        total = 0
+
+        def part_done(future, buf):
+            buffers.put(buf)  # buffer is free for the next part as soon as its upload ends
+            if future.cancelled() or not future.result()[1]:
+                failed.set()
+
+        try:
+            while nbytes > 0 and not failed.is_set():
+                chunk_num += 1
+                total += nbytes
+                if chunk_num > MAX_PARTS:
+                    raise ValueError("stream exceeds %s parts of %s bytes, increase chunksize_mb" % (MAX_PARTS, chunksize))
+                future = pool.submit(self._send_part, mp.id, keyname, keyname, self.attempt_limit, chunk_num, nbytes,
+                                     lambda buf=buf, nbytes=nbytes: _buffer_view(buf, nbytes), time.time())
+                future.add_done_callback(functools.partial(part_done, buf=buf))
+                futures.append(future)
+                buf = buffers.get(timeout=max(0, deadline - time.time()))  # blocks while all buffers are in flight
+                nbytes = filler.fill(buf)
+            buffers.put(buf)
+
+            done, not_done = wait(futures, timeout=max(0, deadline - time.time()))
+            if not_done:
+                raise TimeoutError("upload exceeded timeout of %s seconds" % self.timeout)
+        except Exception as exc:
+            logging.warning("%s failed to upload." % keyname)
+            logging.warning(exc)
+            failed.set()
+            for future in futures:
+                future.cancel()
+
+        for future in futures:
+            if future.done() and not future.cancelled():
+                chunk_num, success, etag, nbytes, elapsed = future.result()
+                if success:
+                    self._record_throughput(nbytes, elapsed)
+        if failed.is_set():
+            logging.warning("Cancelling Multipart Upload of %s." % keyname)
+            wait(futures)
+            mp.cancel_upload()
+            return None
+        if not self._complete_multipart(mp, keyname, len(futures)):
+            return None
+
+        elapsed = time.time() - start_time
+        logging.info("Upload Speed: %f MB/s" % ((total / 2**20) / elapsed))
+        metrics.emit("upload", keyname=keyname, bytes=total, seconds=elapsed, mbps=(total / 2**20) / elapsed)
+        return keyname
+
+    def upload_many(self, files, max_inflight_mb=None, adaptive_chunksize=True):
+        """uploads many files through one shared scheduler on the thread pool. Single-PUT files and the parts of
+        multipart files are fed to the same workers in order, so the next file starts while the last parts of the
+        previous one are still in flight. At most 'max_inflight_mb' of file data is scheduled at any time
+        (default 2 x threads x chunksize). adaptive_chunksize=False keeps part sizes independent of measured
+        throughput, so the ETags S3 assigns can be computed locally (see sync).
+
+        'files' is a list of filenames or (filename, keyname) tuples. Returns a list with, for each file,
+        the keyname on success or None on failure"""
+        if max_inflight_mb is None:
+            max_inflight = 2 * self.threads * self.chunksize
         else:
-            mp = bucket.initiate_multipart_upload(keyname)  # initiate multipart upload
-
-            fchunks = self._file_chunker(mp.id, filename)  # create file chunk generator
-
-            if self.threads == 1:
-                # does not spawn any worker processes, safe for use in multithreaded application
-                result = []
-                try:
-                    for chunk in fchunks:
-                        part_result = self._upload_part(chunk)
-                        result.append(part_result)  # log to results
-                        if not part_result[1]:  # if upload fails, break loop
-                            logging.warning("%s part failed to upload. Cancelling Multipart Upload." % keyname)
-                            mp.cancel_upload()
-                            return None
-                except Exception as exc:
-                    logging.warning("%s failed to upload - general. Cancelling Multipart Upload." % keyname, exc)
-                    mp.cancel_upload()
-                    return None
+            max_inflight = int(max_inflight_mb * 2**20)
+        budget = _ByteBudget(max_inflight)
+        grow_budget = max_inflight_mb is None  # default limit follows the largest chunksize picked
+        pool = self._get_thread_pool()
+
+        uploads = []
+        futures = []
+        for item in files:
+            filename, keyname = item if isinstance(item, tuple) else (item, None)
+            state = _FileUpload(filename, keyname or os.path.basename(filename))
+            uploads.append(state)
+            try:
+                fsize = os.stat(filename).st_size
+                if fsize < MIN_PART_SIZE:
+                    tasks = [(self._scheduled_simple_upload, (state,), fsize)]
+                else:
+                    chunksize = self._chunksize_for(fsize, adaptive_chunksize)
+                    if grow_budget:
+                        budget.raise_limit(2 * self.threads * chunksize)
+                    state.mp = self._worker_bucket().initiate_multipart_upload(state.keyname)
+                    state.num_parts = state.remaining = -(-fsize // chunksize)  # rounded up
+                    tasks = ((self._scheduled_part, (state, chunk), chunk[-1]) for chunk in self._file_chunker(state.mp.id, filename, state.keyname, chunksize))
+            except Exception as exc:
+                logging.warning("%s failed to start upload." % state.keyname)
+                logging.warning(exc)
+                state.failed = True
+                continue
+
+            for func, args, nbytes in tasks:
+                if state.failed:  # a part already failed, do not schedule the rest of the file
+                    break
+                nbytes = budget.acquire(nbytes)
+                future = pool.submit(func, *args, submitted=time.time())
+                future.add_done_callback(lambda f, n=nbytes: budget.release(n))
+                futures.append(future)
+
+        wait(futures)
+        for state in uploads:
+            if state.failed and state.mp is not None:
+                state.cancel()  # covers files whose remaining parts were never scheduled
+        return [None if state.failed else state.keyname for state in uploads]
+
+    def sync(self, local_dir, prefix, delete=False, index_path=None):
+        """uploads the files under 'local_dir' to keys under 'prefix' that are missing or differ in S3.
+
+        Remote keys come from one paginated listing of the prefix. Files whose size matches their key are hashed on
+        'threads' threads into the ETag S3 would give them (plain MD5 below the multipart threshold, MD5 of part MD5s
+        above it, with the part size upload_many uses here) and skipped when it matches. With 'index_path', hashes are
+        kept in a JSON file and reused while a file's size and mtime are unchanged. With 'delete', keys under 'prefix'
+        without a local file are deleted, which needs a non-empty 'prefix'. Keys uploaded by other tools with other part sizes are uploaded once more.
+
+        Returns a dict with the 'uploaded', 'failed' and 'deleted' keynames and the number of 'unchanged' and 'hashed' files"""
+        start_time = time.time()
+        prefix = prefix.strip("/")
+        if delete and not prefix:
+            raise ValueError("sync with delete needs a prefix, it would delete every other key in the bucket")
+
+        local = {}  # keyname -> (filename, relative path, size, mtime)
+        for root, _, names in os.walk(local_dir):
+            for name in names:
+                filename = os.path.join(root, name)
+                rel = os.path.relpath(filename, local_dir).replace(os.sep, "/")
+                fstat = os.stat(filename)
+                local[prefix + "/" + rel if prefix else rel] = (filename, rel, fstat.st_size, fstat.st_mtime)
 
+        remote = dict((key.name, (key.size, key.etag.strip('"')))
+                      for key in self._worker_bucket().list(prefix=prefix + "/" if prefix else ""))
+
+        index = {}
+        if index_path is not None and os.path.exists(index_path):
+            with open(index_path) as fi:
+                index = json.load(fi)
+
+        changed = []
+        to_hash = []
+        for keyname, (filename, rel, size, mtime) in sorted(local.items()):
+            if keyname not in remote or remote[keyname][0] != size:
+                changed.append(keyname)
+                continue
+            chunksize = self._chunksize_for(size, adaptive=False)
+            cached = index.get(rel)
+            if cached is not None and cached["size"] == size and cached["mtime"] == mtime and cached["chunksize"] == chunksize:
+                if cached["etag"] != remote[keyname][1]:
+                    changed.append(keyname)
             else:
-                # spawns multiprocessing worker processes, cannot be used within a Process or Thread object because of GIL. Drop thread count to 1.
+                to_hash.append((keyname, filename, rel, size, mtime, chunksize))
 
-                pool = multiprocessing.Pool(self.threads)  # initialize pool with n threads
+        pool = self._get_thread_pool()
+        etags = pool.map(lambda item: _multipart_etag(item[1], item[5]), to_hash)  # hashlib releases the GIL on large buffers
+        for (keyname, filename, rel, size, mtime, chunksize), etag in zip(to_hash, etags):
+            index[rel] = {"size": size, "mtime": mtime, "chunksize": chunksize, "etag": etag}
+            if etag != remote[keyname][1]:
+                changed.append(keyname)
 
-                # pass generator and helper function to pool, execute asynchronously
-                run_upload = pool.map_async(func=self._upload_part, iterable=fchunks)
+        results = self.upload_many([(local[keyname][0], keyname) for keyname in changed], adaptive_chunksize=False)
+        uploaded = [keyname for keyname in results if keyname is not None]
+        failed = [keyname for keyname, result in zip(changed, results) if result is None]
 
-                # get results of upload as list of tuples, or cancel upload on error (e.g. timeout error)
-                try:
-                    result = run_upload.get(timeout=self.timeout)
-                except Exception as exc:
-                    logging.warning("%s failed to upload. Cancelling Multipart Upload." % keyname)
-                    mp.cancel_upload()
-                    return None
+        deleted = []
+        if delete:
+            to_delete = sorted(keyname for keyname in remote if keyname not in local)
+            if to_delete:
+                result = self.delete(to_delete)  # boto sends these as multi-object deletes of up to 1000 keys
+                deleted = sorted(key.key for key in result.deleted)
+                for error in result.errors:
+                    logging.warning("failed to delete %s: %s" % (error.key, error.message))
 
-            # ensure all chunks uploaded successfully, or cancel upload if success=False for any value
-            for chunk_num, success in result:
-                if not success:
-                    logging.warning("Chunk %s failed to upload" % chunk_num)
-                    mp.cancel_upload()
-                    return None
-
-            # ensure S3 has collected all parts of upload, compare to number of chunks uploaded
-            if len(mp.get_all_parts()) == len(result):
-                try:
-                    mp.complete_upload()
-                    logging.info("%s Upload Complete!" % keyname)
-                except Exception as exc:
-                    mp.cancel_upload()
-                    logging.warning("%s failed to upload compltely. Cancelling Multipart Upload." % keyname)
-                    logging.warning(exc)
-                    return None
+        if index_path is not None:
+            live = set(rel for _, rel, _, _ in local.values())  # entries of removed files are dropped
+            index = dict((rel, entry) for rel, entry in index.items() if rel in live)
+            with open(index_path + ".tmp", "w") as fo:
+                json.dump(index, fo)
+            os.replace(index_path + ".tmp", index_path)
+
+        logging.info("Synced %s to %s: %s uploaded, %s failed, %s unchanged, %s deleted" % (
+            local_dir, prefix, len(uploaded), len(failed), len(local) - len(changed), len(deleted)))
+        metrics.emit("sync", files=len(local), uploaded=len(uploaded), failed=len(failed), deleted=len(deleted), hashed=len(to_hash),
+                     bytes=sum(local[keyname][2] for keyname in uploaded), seconds=time.time() - start_time)
+        return {"uploaded": uploaded, "failed": failed, "deleted": deleted, "unchanged": len(local) - len(changed), "hashed": len(to_hash)}
+
+    def _scheduled_simple_upload(self, state, submitted=None):
+        try:
+            self._simple_upload(state.filename, state.keyname)
+        except Exception as exc:
+            logging.warning("%s failed to upload." % state.keyname)
+            logging.warning(exc)
+            state.failed = True
+
+    def _scheduled_part(self, state, chunk, submitted=None):
+        # parts of a file that already failed are skipped, the last part to finish completes or cancels the upload
+        if not state.failed:
+            chunk_num, success, etag, nbytes, elapsed = self._upload_part(chunk, submitted)
+            if success:
+                self._record_throughput(nbytes, elapsed)
             else:
-                mp.cancel_upload()
-                logging.warning("%s failed to upload completely. Cancelling Multipart Upload." % keyname)
-                return None
+                state.failed = True
+        if state.part_done():
+            if state.failed:
+                state.cancel()
+            elif not self._complete_multipart(state.mp, state.keyname, state.num_parts):
+                state.failed = True
 
-        end_time = time.time()
-        upload_speed_mbps = (fsize / 2**20) / (end_time - start_time)
 
-        logging.info("Upload Speed: %f MB/s" % (upload_speed_mbps))
-        return keyname
+class _BufferPool(object):
+    """fixed number of reusable part buffers, allocated on first use"""
+
+    def __init__(self, size, count):
+        self.size = size
+        self._free = queue.Queue()
+        self._allocated = 0
+        self._count = count
+        self._lock = threading.Lock()
+
+    def get(self, timeout=None):
+        with self._lock:
+            if self._free.empty() and self._allocated < self._count:
+                self._allocated += 1
+                return bytearray(self.size)
+        try:
+            return self._free.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("no part buffer freed within %s seconds" % timeout)
+
+    def put(self, buf):
+        self._free.put(buf)
+
+
+class _ByteBudget(object):
+    """counting semaphore over bytes, bounds the data scheduled on upload workers"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        # a single item larger than the limit is admitted alone rather than waiting forever
+        nbytes = min(nbytes, self.limit)
+        with self._cond:
+            while self.used + nbytes > self.limit:
+                self._cond.wait()
+            self.used += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    def raise_limit(self, limit):
+        with self._cond:
+            if limit > self.limit:
+                self.limit = limit
+                self._cond.notify_all()
+
+
+class _FileUpload(object):
+    """per-file state for upload_many"""
+
+    def __init__(self, filename, keyname):
+        self.filename = filename
+        self.keyname = keyname
+        self.mp = None
+        self.num_parts = 0
+        self.remaining = 0  # parts not yet finished
+        self.failed = False
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def part_done(self):
+        """marks one part finished, returns True for the last part"""
+        with self._lock:
+            self.remaining -= 1
+            return self.remaining == 0
+
+    def cancel(self):
+        # cancels a failed multipart upload exactly once
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+        logging.warning("%s part failed to upload. Cancelling Multipart Upload." % self.keyname)
+        try:
+            self.mp.cancel_upload()
+        except Exception as exc:
+            logging.warning(exc)
+
+
+class S3Downloader(_S3Client):
+    """parallel downloader. Large keys are fetched as byte ranges written straight into a preallocated,
+    memory-mapped output file, and many keys (a prefix or an UNLOAD manifest) share one thread pool"""
+
+    def __init__(self, s3conf, bucketname, threads=4, chunksize_mb=8, attempt_limit=5, backoff_base=0.5, backoff_cap=20):
+        super(S3Downloader, self).__init__(s3conf, bucketname, backoff_base, backoff_cap)
+        if threads <= 0:
+            raise ValueError("threads must be > 0")
+        self.threads = threads  # number of parallel range requests
+        self.chunksize = int(chunksize_mb * 2**20)  # bytes per range request
+        self.attempt_limit = attempt_limit  # attempts per range
+        self._pool_lock = threading.Lock()
+        self._pool = None  # thread pool, created on first use and kept across calls
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """shuts down the thread pool, if one was started"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.threads)
+            return self._pool
+
+    def list_keys(self, prefix):
+        """returns [(keyname, size)] for every key under 'prefix', in one paginated listing"""
+        return [(key.name, key.size) for key in self._worker_bucket().list(prefix=prefix)]
+
+    def manifest_keys(self, manifest_keyname):
+        """returns [(keyname, size)] for the entries of an UNLOAD manifest stored in this bucket"""
+        keys = []
+        for bucketname, keyname, size in parse_unload_manifest(self._worker_bucket().get_key(manifest_keyname).get_contents_as_string()):
+            if bucketname != self.bucketname:
+                raise ValueError("manifest entry s3://%s/%s is not in bucket %s" % (bucketname, keyname, self.bucketname))
+            keys.append((keyname, size))
+        return keys
+
+    def download(self, keyname, filename=None, decompress=False):
+        """downloads one key, returns the local filename or None on failure"""
+        return self.download_many([keyname], decompress=decompress, filenames=None if filename is None else [filename])[0]
+
+    def download_prefix(self, prefix, target_dir, decompress=False):
+        """downloads every key under 'prefix' concurrently, returns the local filenames (None for failed keys).
+        Keys keep their path below 'prefix' under 'target_dir', so equal basenames in different sub-prefixes
+        (e.g. partitioned exports) do not collide"""
+        keys = [(keyname, size) for keyname, size in self.list_keys(prefix) if not keyname.endswith("/")]  # skip folder markers
+        base = prefix.rstrip("/")
+        if not any(keyname.startswith(base + "/") for keyname, _ in keys):
+            base = prefix.rpartition("/")[0]  # a partial name like 'exp/part_' keeps the keys' own names
+        target_root = os.path.abspath(target_dir)
+        filenames = []
+        for keyname, _ in keys:
+            rel = keyname[len(base):].lstrip("/") if keyname.startswith(base) else keyname
+            if decompress and rel.endswith(".gz"):
+                rel = rel[:-3]
+            filename = os.path.abspath(os.path.join(target_root, *rel.split("/")))
+            if not filename.startswith(target_root + os.sep):
+                raise ValueError("key %s would be saved outside %s" % (keyname, target_dir))
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            filenames.append(filename)
+        return self.download_many(keys, target_dir, decompress, filenames=filenames)
+
+    def download_manifest(self, manifest_keyname, target_dir, decompress=False):
+        """downloads every file listed in an UNLOAD manifest concurrently, returns the local filenames (None for failed keys)"""
+        return self.download_many(self.manifest_keys(manifest_keyname), target_dir, decompress)
+
+    def download_many(self, keys, target_dir=None, decompress=False, filenames=None):
+        """downloads keys concurrently on one thread pool. 'keys' are keynames or (keyname, size) tuples.
+        Each key is saved under its basename in 'target_dir' (default current directory) unless 'filenames' are given.
+        With 'decompress', GZIP keys are streamed through a decompressor and saved without the .gz suffix.
+        Raises ValueError if two keys would be saved to the same file. Returns the local filenames, with None for keys that failed"""
+        target_dir = os.getcwd() if target_dir is None else target_dir
+        pool = self._get_pool()
+
+        items = []  # (keyname, size, gunzip, filename)
+        for i, item in enumerate(keys):
+            keyname, size = item if isinstance(item, tuple) else (item, None)
+            gunzip = decompress and keyname.endswith(".gz")
+            if filenames is not None:
+                filename = filenames[i]
+            else:
+                filename = os.path.join(target_dir, os.path.basename(keyname)[:-3] if gunzip else os.path.basename(keyname))
+            items.append((keyname, size, gunzip, filename))
+
+        seen = {}
+        for keyname, _, _, filename in items:
+            other = seen.setdefault(os.path.abspath(filename), keyname)
+            if other != keyname:
+                raise ValueError("%s and %s would both be saved to %s" % (other, keyname, filename))
+
+        jobs = []  # (filename, [futures])
+        for keyname, size, gunzip, filename in items:
+            try:
+                if gunzip:
+                    # decompression is sequential, so the whole key is one streamed GET
+                    futures = [pool.submit(self._get_decompressed, keyname, filename)]
+                else:
+                    if size is None:
+                        size = self._worker_bucket().get_key(keyname).size
+                    with open(filename, "wb") as fo:
+                        fo.truncate(size)  # preallocate, ranges are written in place
+                    futures = [pool.submit(self._get_range, keyname, filename, start, min(start + self.chunksize, size))
+                               for start in range(0, size, self.chunksize)]
+            except Exception as exc:
+                logging.warning("%s failed to start download." % keyname)
+                logging.warning(exc)
+                futures = None
+            jobs.append((filename, futures))
+
+        results = []
+        for filename, futures in jobs:
+            if futures is not None and all(future.result() for future in futures):
+                results.append(filename)
+            else:
+                results.append(None)
+        return results
+
+    def _get_range(self, keyname, filename, start, end):
+        """fetches bytes [start, end) of a key into the same bytes of the local file, with retries"""
+        attempts = 0
+        while attempts < self.attempt_limit:
+            if attempts > 0:
+                self._backoff(attempts)
+            attempts += 1
+            try:
+                with open(filename, "r+b") as fo, mmap.mmap(fo.fileno(), 0) as mm:
+                    view = memoryview(mm)[start:end]
+                    try:
+                        key = self._worker_bucket().new_key(keyname)
+                        key.open_read(headers={"Range": "bytes=%d-%d" % (start, end - 1)})
+                        pos = 0
+                        while pos < len(view):
+                            n = key.resp.readinto(view[pos:])  # read from the socket directly into the file's pages
+                            if not n:
+                                break
+                            pos += n
+                        key.close()
+                    finally:
+                        view.release()
+                if pos != end - start:
+                    raise IOError("%s range %s-%s returned %s bytes" % (keyname, start, end - 1, pos))
+                return True
+            except Exception as exc:
+                logging.info("%s Range %s-%s download failed on attempt #%s." % (keyname, start, end - 1, attempts))
+                logging.warning(exc)
+                self._reset_worker_bucket()
+        return False
+
+    def _get_decompressed(self, keyname, filename):
+        """streams a GZIP key through a decompressor into the local file, with retries of the whole key"""
+        attempts = 0
+        while attempts < self.attempt_limit:
+            if attempts > 0:
+                self._backoff(attempts)
+            attempts += 1
+            try:
+                key = self._worker_bucket().new_key(keyname)
+                key.open_read()
+                with open(filename, "wb") as fo:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    while True:
+                        data = key.resp.read(2**20)
+                        if not data:
+                            break
+                        while data:
+                            fo.write(decompressor.decompress(data))
+                            # a file may hold several concatenated gzip members, start a new decompressor for each
+                            data = decompressor.unused_data if decompressor.eof else b""
+                            if data:
+                                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    fo.write(decompressor.flush())
+                key.close()
+                return True
+            except Exception as exc:
+                logging.info("%s Download failed on attempt #%s." % (keyname, attempts))
+                logging.warning(exc)
+                self._reset_worker_bucket()
+        return False
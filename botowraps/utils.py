@@ -3,24 +3,93 @@
 # standard lib imports
 import os
 import gzip
+import mmap
 import shutil
 import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 # functions
-def gzc(filename, target_dir=None, remove=False):
+def gzc(filename, target_dir=None, remove=False, level=9, workers=1, blocksize_mb=16, shards=None, executor="thread"):
+    """compresses 'filename' with gzip, returns the '.gz' filename.
+    With workers > 1 or shards, the file is cut into blocks ending on newlines which are compressed in parallel on a
+    thread (or process) pool and written, in order, as concatenated gzip members. 'shards' splits the output into that
+    many files named <filename>.<n>.gz and returns their list. Exactly 'shards' files are written: when the file has
+    fewer blocks than shards, the shards left over hold an empty gzip member. Redshift COPY ... GZIP reads multi-member files"""
     # adapted from gzip documentation
 
     if target_dir is None:
         target_dir = os.path.dirname(os.path.abspath(filename))
 
     fo_name = os.path.join(target_dir, os.path.basename(filename) + ".gz")
-    with open(filename, 'rb') as fi:
-        with gzip.open(fo_name, 'wb') as fo:
-            shutil.copyfileobj(fi, fo)
+    if workers <= 1 and shards is None:
+        with open(filename, 'rb') as fi:
+            with gzip.open(fo_name, 'wb', compresslevel=level) as fo:
+                shutil.copyfileobj(fi, fo)
+        if remove:
+            os.unlink(filename)
+        return fo_name
+
+    if executor not in ("thread", "process"):
+        raise ValueError("executor must be one of: [thread, process]")
+    pool_class = ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor  # zlib releases the GIL, threads are usually enough
+
+    if shards is not None and shards < 1:
+        raise ValueError("shards must be >= 1")
+
+    fsize = os.stat(filename).st_size
+    blocksize = int(blocksize_mb * 2**20)
+    if shards is not None:
+        blocksize = max(2**16, min(blocksize, fsize // (shards * 4)))  # several blocks per shard keeps shards even
+
+    outputs = {}  # shard number -> open file
+    try:
+        with open(filename, 'rb') as fi, pool_class(max_workers=max(1, workers)) as pool:
+            pending = collections.deque()  # (shard, future) in file order
+            offset = 0
+            for block in _line_blocks(fi, blocksize):
+                shard = 1 if shards is None else min(shards, offset * shards // fsize + 1)
+                offset += len(block)
+                pending.append((shard, pool.submit(gzip.compress, block, level)))
+                while len(pending) > 2 * max(1, workers):  # bound memory to a few blocks per worker
+                    shard, future = pending.popleft()
+                    _write_block(outputs, shard, future.result(), target_dir, filename, shards)
+            while pending:
+                shard, future = pending.popleft()
+                _write_block(outputs, shard, future.result(), target_dir, filename, shards)
+
+        # empty input, or fewer blocks than shards, still writes every file as a valid empty gzip
+        empty = gzip.compress(b"", level)
+        for shard in range(1, (shards or 1) + 1):
+            if shard not in outputs:
+                _write_block(outputs, shard, empty, target_dir, filename, shards)
+    finally:
+        for fo in outputs.values():
+            fo.close()
     if remove:
         os.unlink(filename)
-    return fo_name
+    if shards is None:
+        return fo_name
+    return [outputs[shard].name for shard in sorted(outputs)]
+
+
+def _line_blocks(fi, blocksize):
+    """generator of blocks of about 'blocksize' bytes from an open binary file, each ending on a newline"""
+    while True:
+        block = fi.read(blocksize)
+        if not block:
+            return
+        if not block.endswith(b"\n"):
+            block += fi.readline()  # finish the current row so no row spans two blocks
+        yield block
+
+
+def _write_block(outputs, shard, data, target_dir, filename, shards):
+    if shard not in outputs:
+        suffix = ".gz" if shards is None else ".{}.gz".format(shard)
+        outputs[shard] = open(os.path.join(target_dir, os.path.basename(filename) + suffix), 'wb')
+    outputs[shard].write(data)
 
 
 def split_csv_by_row(filename, rows_per_file=10000, target_dir=None, header_action="na"):
@@ -75,3 +144,160 @@ def split_csv_by_row(filename, rows_per_file=10000, target_dir=None, header_acti
         out.close()
 
     return output_file_list
+
+
+def split_csv(filename, shards=None, shard_size_mb=None, target_dir=None, header_action="na", compress=False, level=6, workers=4):
+    """splits a .csv file into byte-balanced shards with a suffix .n (.n.gz when compressed) after the filename.
+    Give either the number of 'shards' or a target 'shard_size_mb'. Shards are cut on newline boundaries found in a
+    memory map of the file and written in parallel, optionally gzipped inline. 'header_action' works as in
+    split_csv_by_row. Assumes at most 1 header row and no newlines inside quoted fields"""
+    # input error handling
+    header_opts = ["delete", "keep", "na"]
+    if header_action not in header_opts:
+        raise ValueError("arg header_action must be one of: [%s]" % ", ".join(header_opts))
+    if (shards is None) == (shard_size_mb is None):
+        raise ValueError("exactly one of shards or shard_size_mb must be given")
+
+    new_filename = filename
+    if target_dir is not None:
+        new_filename = os.path.join(target_dir, os.path.basename(filename))
+
+    fsize = os.stat(filename).st_size
+    if fsize == 0:
+        return []
+
+    with open(filename, "rb") as original, mmap.mmap(original.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header = b""
+        data_start = 0
+        if header_action != "na":
+            data_start = mm.find(b"\n") + 1 or fsize  # a file without newline is all header
+            if header_action == "keep":
+                header = mm[:data_start]
+
+        data_size = fsize - data_start
+        if data_size == 0 and not header:
+            return []
+        if shards is None:
+            shards = max(1, -(-data_size // int(shard_size_mb * 2**20)))  # rounded up
+
+        # cut points at even byte offsets, moved forward to the next row start
+        bounds = [data_start]
+        for i in range(1, shards):
+            cut = mm.find(b"\n", data_start + data_size * i // shards)
+            cut = fsize if cut == -1 else cut + 1
+            if cut > bounds[-1] and cut < fsize:
+                bounds.append(cut)
+        bounds.append(fsize)
+
+        output_file_list = []
+        jobs = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for filenum, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]), 1):
+                output_file_name = new_filename + "." + str(filenum) + (".gz" if compress else "")
+                output_file_list.append(output_file_name)
+                jobs.append(pool.submit(_write_shard, mm, start, end, header, output_file_name, compress, level))
+            for job in jobs:
+                job.result()  # re-raise write errors
+
+    return output_file_list
+
+
+def _write_shard(mm, start, end, header, output_file_name, compress, level, piece=16 * 2**20):
+    # copies mm[start:end] to the shard file in pieces, so a shard is never held in memory whole
+    out = gzip.open(output_file_name, "wb", compresslevel=level) if compress else open(output_file_name, "wb")
+    with out:
+        if header:
+            out.write(header)
+        view = memoryview(mm)
+        try:
+            for pos in range(start, end, piece):
+                out.write(view[pos:min(pos + piece, end)])
+        finally:
+            view.release()
+
+
+def _pyarrow():
+    # pyarrow is only needed for Parquet and Feather files, so it is imported on first use
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Feather support requires the pyarrow package")
+    return pyarrow
+
+
+def write_parquet(source, filename, shard_size_mb=64, rows_per_group=100000, compression="snappy", delimiter=",", column_types=None, schema=None):
+    """writes a DataFrame or a .csv file (with a header row) as Parquet shards named <filename>.<n>.parquet, returns their list.
+    Rows are written in row groups of 'rows_per_group' rows and a new shard is started once the current one
+    reaches 'shard_size_mb', so shards come out about the size of an upload. A .csv source is streamed, not loaded whole.
+
+    Column types of a .csv source are inferred from its first block. Columns whose values widen later on (e.g. ints
+    followed by floats) need 'column_types', a dict of column name to pyarrow type or type name, or a full pyarrow 'schema'"""
+    pa = _pyarrow()
+
+    if schema is not None:
+        column_types = dict((field.name, field.type) for field in schema)
+
+    if isinstance(source, str):
+        convert_options = pa.csv.ConvertOptions(column_types=column_types or {})
+        reader = pa.csv.open_csv(source, parse_options=pa.csv.ParseOptions(delimiter=delimiter), convert_options=convert_options)
+        schema = reader.schema
+        batches = _regroup(pa, (pa.Table.from_batches([batch]) for batch in reader), rows_per_group, source)
+    else:
+        table = pa.Table.from_pandas(source, preserve_index=False)
+        if column_types:
+            table = table.cast(pa.schema([pa.field(f.name, column_types.get(f.name, f.type)) for f in table.schema]))
+        schema = table.schema
+        batches = (table.slice(i, rows_per_group) for i in range(0, max(table.num_rows, 1), rows_per_group))
+
+    shard_size = int(shard_size_mb * 2**20)
+    output_file_list = []
+    writer = fo = None
+    try:
+        for batch in batches:
+            if writer is None:
+                output_file_list.append("%s.%d.parquet" % (filename, len(output_file_list) + 1))
+                fo = open(output_file_list[-1], "wb")
+                writer = pa.parquet.ParquetWriter(fo, schema, compression=compression)
+            writer.write_table(batch, row_group_size=rows_per_group)
+            if fo.tell() >= shard_size:  # the file position only counts row groups already flushed
+                writer.close()
+                fo.close()
+                writer = fo = None
+    finally:
+        if writer is not None:
+            writer.close()
+            fo.close()
+
+    return output_file_list
+
+
+def _regroup(pa, tables, rows, source):
+    # generator that re-cuts a stream of small tables into tables of exactly 'rows' rows, the last one shorter
+    pending, pending_rows = [], 0
+    try:
+        for table in tables:
+            pending.append(table)
+            pending_rows += table.num_rows
+            while pending_rows >= rows:
+                merged = pa.concat_tables(pending)
+                yield merged.slice(0, rows)
+                pending, pending_rows = [merged.slice(rows)], merged.num_rows - rows
+    except pa.ArrowInvalid as exc:
+        raise ValueError("%s: %s. Pass column_types or schema for columns whose type changes after the first block" % (source, exc))
+    if pending_rows:
+        yield pa.concat_tables(pending)
+
+
+def read_parquet(filenames, columns=None, workers=4):
+    """reads Parquet files, e.g. the parts of an UNLOAD ... FORMAT AS PARQUET, into one DataFrame.
+    Files are memory-mapped and decoded on 'workers' threads. Ints with NULLs become float64 and dates datetime64"""
+    pa = _pyarrow()
+
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        tables = list(pool.map(lambda f: pa.parquet.read_table(f, columns=columns, memory_map=True, use_threads=False), filenames))
+    return pa.concat_tables(tables).to_pandas(date_as_object=False)